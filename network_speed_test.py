@@ -1,29 +1,956 @@
+import argparse
+import collections
+import csv
+import glob
+import gzip
+import io
+import json
+import math
+import os
+import queue
+import random
 import schedule
+import socket
 import speedtest
 import sys
 import time
 import threading
+import zlib
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from urllib.request import Request, urlopen
+
+
+################################################################################
+# This class keeps track of the bytes used by speed tests over a rolling day,
+# so that tests on metered links stay within a daily data budget.
+# Concurrent runs reserve their share before testing and settle it after.
+################################################################################
+class DailyBudget(object):
+
+    def __init__(self, limit, window=86400):
+        self.limit = limit
+        self.window = window
+        self.entries = collections.deque()
+        self.lock = threading.Lock()
+
+    def _expire(self):
+        cutoff = time.time() - self.window
+        while self.entries and self.entries[0][0] < cutoff:
+            self.entries.popleft()
+
+    def reserve(self, wanted=None):
+        #Reserve up to wanted bytes, or all that is left, and return the entry
+        with self.lock:
+            self._expire()
+            remaining = max(0, self.limit - sum(entry[1] for entry in self.entries))
+            if wanted is not None:
+                remaining = min(remaining, wanted)
+            entry = [time.time(), remaining]
+            self.entries.append(entry)
+            return entry
+
+    def settle(self, entry, used):
+        #Replace a reservation with the bytes that were actually used
+        with self.lock:
+            entry[1] = used
+
+
+################################################################################
+# This class probes the latency to the cached best server every few seconds
+# over a keep-alive connection, keeping latency and reachability in a ring
+# buffer, and reports when the link looks degraded so that a full test can be
+# run straight away instead of waiting for the regular interval.
+################################################################################
+class LinkProbe(object):
+
+    def __init__(self, history=720, failures=2, factor=2.0):
+        self.samples = collections.deque(maxlen=history)
+        self.failures = failures
+        self.factor = factor
+        self.degraded = False
+        self.prober = None
+        #Held while probing, so a slow probe is skipped rather than stacked
+        self.running = threading.Lock()
+
+    def probe(self):
+        #Probe once, returning the reason the link is degraded or None
+        if self.prober is None:
+            try:
+                #No warm connections, the probe only needs its own
+                speedtester = speedtest.Speedtest(prewarm=False)
+                speedtester.get_best_server()
+                self.prober = speedtester.keep_alive_probe()
+            except Exception:
+                self.prober = None
+        latency = None
+        if self.prober is not None:
+            latency = self.prober.probe()
+        self.samples.append((time.time(), latency))
+        return self.check()
+
+    def check(self):
+        recent = [latency for _, latency in list(self.samples)[-self.failures:]]
+        if len(recent) == self.failures and all(latency is None for latency in recent):
+            #Pick the best server again, in case only it went away
+            if self.prober is not None:
+                self.prober.close()
+            self.prober = None
+            return 'unreachable'
+
+        latencies = [latency for _, latency in self.samples if latency is not None]
+        if len(latencies) < 10:
+            return None
+        baseline = median(latencies)
+        current = median(latencies[-3:])
+        if current > baseline * self.factor:
+            return 'latency {:.1f} ms against {:.1f} ms'.format(current, baseline)
+        return None
+
+    def reachability(self):
+        #Fraction of the buffered probes that got a reply
+        if not self.samples:
+            return None
+        return sum(1 for _, latency in self.samples if latency is not None) / float(len(self.samples))
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+################################################################################
+# This class flags anomalies in download, upload and ping. It keeps an
+# exponentially weighted mean and variance of each, and flags a result that
+# is more than threshold standard deviations from the mean once warmed up.
+# Flagged results are left out of the mean until rebase accepts them.
+################################################################################
+class AnomalyDetector(object):
+
+    def __init__(self, alpha=0.2, threshold=3.0, warmup=5, floor=0.05):
+        self.alpha = alpha
+        self.threshold = threshold
+        self.warmup = warmup
+        #Smallest deviation considered, as a fraction of the mean, so that a
+        #very steady link does not flag every small wobble
+        self.floor = floor
+        self.mean = {}
+        self.variance = {}
+        self.count = 0
+
+    def update(self, sample):
+        #Add a dictionary of results, returning the names of the anomalous ones
+        anomalies = []
+        for name, value in sample.items():
+            if name not in self.mean:
+                self.mean[name] = value
+                self.variance[name] = 0.0
+                continue
+            deviation = value - self.mean[name]
+            spread = max(math.sqrt(self.variance[name]), self.floor * abs(self.mean[name]))
+            if self.count >= self.warmup and abs(deviation) > self.threshold * spread:
+                anomalies.append(name)
+                continue
+            self.mean[name] += self.alpha * deviation
+            self.variance[name] = (1 - self.alpha) * (self.variance[name] + self.alpha * deviation ** 2)
+        self.count += 1
+        return sorted(anomalies)
+
+    def rebase(self, sample, names):
+        #Accept the named results as the new normal after a confirmed change
+        for name in names:
+            self.mean[name] = sample[name]
+
+
+################################################################################
+# This class decides when the next full test is due. The interval grows while
+# results are stable and drops back to the minimum on an anomaly, which is
+# followed by a quick retest to confirm it.
+################################################################################
+class AdaptiveScheduler(object):
+
+    def __init__(self, detector=None, minimum=30, maximum=600, growth=1.5, confirm=5):
+        self.detector = detector or AnomalyDetector()
+        self.minimum = minimum
+        self.maximum = maximum
+        self.growth = growth
+        self.confirm = confirm
+        self.interval = minimum
+        self.next_run = time.time()
+        self.confirming = None
+        self.lock = threading.Lock()
+
+    def due(self):
+        #Return True once when the next test is due
+        with self.lock:
+            now = time.time()
+            if now < self.next_run:
+                return False
+            #Pushed back by record, or kept if the test fails
+            self.next_run = now + self.interval
+            return True
+
+    def record(self, download, upload, ping):
+        #Add the results of a test and pick the time of the next one
+        with self.lock:
+            sample = {'download': download, 'upload': upload, 'ping': ping}
+            anomalies = self.detector.update(sample)
+            now = time.time()
+            if self.confirming is not None:
+                confirmed = [name for name in anomalies if name in self.confirming]
+                if confirmed:
+                    self.detector.rebase(sample, confirmed)
+                    print('Anomaly confirmed: {}    Time: {}'.format(', '.join(confirmed), time.ctime()))
+                else:
+                    print('Anomaly not confirmed: {}    Time: {}'.format(', '.join(self.confirming), time.ctime()))
+                self.confirming = None
+                self.interval = self.minimum
+            elif anomalies:
+                print('Anomaly: {}    Time: {}'.format(', '.join(anomalies), time.ctime()))
+                self.confirming = anomalies
+                self.interval = self.minimum
+                self.next_run = now + self.confirm
+                return
+            else:
+                self.interval = min(self.maximum, self.interval * self.growth)
+            self.next_run = now + self.interval
+
+
+################################################################################
+# This class estimates quantiles in constant memory. Values are counted in
+# logarithmic bins, so that every quantile is within accuracy of the true
+# value relative to it, and two sketches merge by adding their bins. Past
+# max_bins the lowest bins are folded together, losing accuracy at the low end.
+################################################################################
+class QuantileSketch(object):
+
+    def __init__(self, accuracy=0.01, max_bins=256):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.bins = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, value, count=1):
+        if value <= 0:
+            self.zeros += count
+        else:
+            key = int(math.ceil(math.log(value) / self.log_gamma))
+            self.bins[key] = self.bins.get(key, 0) + count
+            self._collapse()
+        self.count += count
+
+    def merge(self, other):
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self._collapse()
+
+    def _collapse(self):
+        if len(self.bins) <= self.max_bins:
+            return
+        keys = sorted(self.bins)
+        folded = keys[:len(keys) - self.max_bins + 1]
+        target = folded[-1]
+        self.bins[target] = sum(self.bins.pop(key) for key in folded[:-1]) + self.bins[target]
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if rank < seen:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+
+################################################################################
+# This class summarises a stream of values with its count, mean, minimum,
+# maximum and quantiles. Summaries merge, so windows can be built from slots.
+################################################################################
+class Summary(object):
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.sketch = QuantileSketch()
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+        self.sketch.add(value)
+
+    def merge(self, other):
+        if not other.count:
+            return
+        self.count += other.count
+        self.total += other.total
+        self.minimum = other.minimum if self.minimum is None else min(self.minimum, other.minimum)
+        self.maximum = other.maximum if self.maximum is None else max(self.maximum, other.maximum)
+        self.sketch.merge(other.sketch)
+
+    def dict(self):
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count, 2),
+            'min': self.minimum,
+            'max': self.maximum,
+            'p50': round(self.sketch.quantile(0.5), 2),
+            'p90': round(self.sketch.quantile(0.9), 2),
+            'p99': round(self.sketch.quantile(0.99), 2),
+        }
+
+
+################################################################################
+# This class keeps a Summary per slot of a sliding window in a ring buffer,
+# so a window of any uptime is answered from a fixed number of slots.
+################################################################################
+class WindowedSummary(object):
+
+    def __init__(self, window, slots):
+        self.width = window / float(slots)
+        self.slots = [None] * slots
+        self.indexes = [None] * slots
+
+    def add(self, value, now=None):
+        index = int((now or time.time()) // self.width)
+        position = index % len(self.slots)
+        if self.indexes[position] != index:
+            self.slots[position] = Summary()
+            self.indexes[position] = index
+        self.slots[position].add(value)
+
+    def summary(self, now=None):
+        index = int((now or time.time()) // self.width)
+        merged = Summary()
+        for position, slot in enumerate(self.slots):
+            if slot is not None and index - self.indexes[position] < len(self.slots):
+                merged.merge(slot)
+        return merged
+
+
+################################################################################
+# This class maintains streaming statistics of download, upload and ping:
+# an EWMA and a Summary over the whole uptime, and Summaries over the last
+# hour and day, all in memory that does not grow with uptime.
+################################################################################
+class StreamingStats(object):
+
+    WINDOWS = (('1h', 3600, 60), ('24h', 86400, 96))
+
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.ewma = {}
+        self.lifetime = {}
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def add(self, sample, now=None):
+        #Add a dictionary of results
+        with self.lock:
+            for name, value in sample.items():
+                if name not in self.lifetime:
+                    self.ewma[name] = value
+                    self.lifetime[name] = Summary()
+                    self.windows[name] = dict((window, WindowedSummary(length, slots))
+                                              for window, length, slots in self.WINDOWS)
+                self.ewma[name] += self.alpha * (value - self.ewma[name])
+                self.lifetime[name].add(value)
+                for window in self.windows[name].values():
+                    window.add(value, now)
+
+    def report(self, now=None):
+        #Return the statistics of each result as a dictionary
+        with self.lock:
+            report = {}
+            for name in self.lifetime:
+                report[name] = {
+                    'ewma': round(self.ewma[name], 2),
+                    'lifetime': self.lifetime[name].dict(),
+                }
+                for window, summary in self.windows[name].items():
+                    report[name][window] = summary.summary(now).dict()
+            return report
+
+
+################################################################################
+# This class tracks the test in flight and the results of the last one.
+# Only one test runs at a time, and a test started while another is in flight
+# is coalesced onto it, whether it comes from the timer or the HTTP API.
+################################################################################
+class TestTracker(object):
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.count = 0
+        self.running = None
+        self.started = None
+        self.latest = None
+
+    def begin(self):
+        #Return the id of a new test, or None if one is already in flight
+        with self.condition:
+            if self.running is not None:
+                return None
+            self.count += 1
+            self.running = self.count
+            self.started = time.time()
+            return self.running
+
+    def end(self, test_id, results):
+        with self.condition:
+            self.latest = dict(results, id=test_id, started=self.started, finished=time.time())
+            self.running = None
+            self.condition.notify_all()
+            return self.latest
+
+    def busy(self):
+        return self.running is not None
+
+    def trigger(self):
+        #Start a test unless one is in flight, returning the id of the test that will report
+        with self.condition:
+            test_id = self.begin()
+            if test_id is None:
+                return self.running
+        run_threaded(lambda: main(test_id))
+        return test_id
+
+    def wait(self, test_id, timeout=None):
+        #Wait for the results of test_id, or None on timeout
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.latest is None or self.latest['id'] < test_id:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            return self.latest
+
+    def status(self):
+        with self.condition:
+            return {
+                'state': 'running' if self.running is not None else 'idle',
+                'id': self.running,
+                'started': self.started if self.running is not None else None,
+                'latest': self.latest['id'] if self.latest is not None else None,
+            }
+
+
+################################################################################
+# This class serves the local HTTP API of the daemon:
+#   POST /test      start a test, or join the one in flight (?wait=SECONDS)
+#   GET  /status    whether a test is running
+#   GET  /results   results of the last test
+#   GET  /stats     streaming statistics of all results
+################################################################################
+class ApiHandler(BaseHTTPRequestHandler):
+
+    #Longest a client may hold a request open waiting for results
+    MAX_WAIT = 3600
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/test':
+            return self.reply(404, {'error': 'not found'})
+        query = parse_qs(url.query)
+        timeout = None
+        if 'wait' in query:
+            try:
+                timeout = float(query['wait'][0])
+            except ValueError:
+                timeout = None
+            if timeout is None or not math.isfinite(timeout) or timeout < 0:
+                return self.reply(400, {'error': 'wait must be a number of seconds'})
+            timeout = min(timeout, self.MAX_WAIT)
+        test_id = TRACKER.trigger()
+        if timeout is not None:
+            results = TRACKER.wait(test_id, timeout)
+            if results is not None:
+                return self.reply(200, results)
+        self.reply(202, {'id': test_id, 'state': 'running'})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/status':
+            self.reply(200, TRACKER.status())
+        elif url.path == '/results':
+            if TRACKER.latest is None:
+                return self.reply(404, {'error': 'no results yet'})
+            self.reply(200, TRACKER.latest)
+        elif url.path == '/stats':
+            self.reply(200, STATS.report())
+        else:
+            self.reply(404, {'error': 'not found'})
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        #Keep the output to test results
+        pass
+
+
+################################################################################
+# This class ships results to a collector in gzipped JSON batches from a
+# background thread. Results are buffered in memory, the oldest dropped once
+# the buffer is full, so a collector outage never blocks or slows the tests.
+# Failed batches are retried with exponential backoff and jitter.
+################################################################################
+class ResultShipper(threading.Thread):
+
+    def __init__(self, url, probe, batch=50, buffer=10000, interval=10, backoff=2, max_backoff=300, timeout=10):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.url = url
+        self.probe = probe
+        self.batch = batch
+        self.buffer = collections.deque(maxlen=buffer)
+        self.interval = interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.failures = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+
+    def submit(self, result):
+        #Queue a result for shipping, without ever waiting
+        with self.lock:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.dropped += 1
+            self.buffer.append(dict(result, probe=self.probe))
+        #Ship a full batch early, but never cut a retry backoff short
+        if len(self.buffer) >= self.batch and not self.failures:
+            self.wake.set()
+
+    def run(self):
+        while True:
+            delay = self.interval
+            if self.failures:
+                delay = min(self.max_backoff, self.backoff ** self.failures) * random.uniform(0.5, 1.0)
+            self.wake.wait(delay)
+            self.wake.clear()
+            while self.ship():
+                pass
+
+    def ship(self):
+        #Send one batch, returning True if more results are waiting
+        with self.lock:
+            batch = [self.buffer.popleft() for _ in range(min(self.batch, len(self.buffer)))]
+        if not batch:
+            return False
+        request = Request(self.url, data=gzip.compress(json.dumps(batch).encode()),
+                          headers={'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+        try:
+            urlopen(request, timeout=self.timeout).read()
+        except Exception as e:
+            #Put the batch back in front, unless newer results have filled the buffer
+            with self.lock:
+                kept = batch[max(0, len(batch) - (self.buffer.maxlen - len(self.buffer))):]
+                self.dropped += len(batch) - len(kept)
+                self.buffer.extendleft(reversed(kept))
+            self.failures += 1
+            print('Collector unavailable: {}    Retrying in up to {}s    Time: {}'.format(
+                e, min(self.max_backoff, self.backoff ** self.failures), time.ctime()))
+            return False
+        self.failures = 0
+        return len(self.buffer) > 0
+
+
+################################################################################
+# This class serves the collector mode, accepting batches of results from
+# many probes on POST /ingest and serving the latest result of each probe on
+# GET /probes
+################################################################################
+class CollectorHandler(ApiHandler):
+
+    MAX_BODY = 10 * 1024 * 1024
+    #Limit on a batch once gzip is undone, against decompression bombs
+    MAX_DECOMPRESSED = 10 * MAX_BODY
+    #Shared by the handlers of all requests
+    latest = {}
+    lock = threading.Lock()
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/ingest':
+            return self.reply(404, {'error': 'not found'})
+        try:
+            length = int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            return self.reply(411, {'error': 'length required'})
+        if length > self.MAX_BODY:
+            return self.reply(413, {'error': 'batch too large'})
+        body = self.rfile.read(length)
+        try:
+            if self.headers.get('Content-Encoding', 'identity') == 'gzip':
+                inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                body = inflater.decompress(body, self.MAX_DECOMPRESSED)
+                if inflater.unconsumed_tail:
+                    return self.reply(413, {'error': 'batch too large'})
+                if not inflater.eof:
+                    raise ValueError('truncated gzip body')
+            batch = json.loads(body.decode())
+            if not isinstance(batch, list):
+                raise ValueError('batch is not a list')
+            #Check the whole batch before applying any of it
+            received = []
+            for result in batch:
+                if not isinstance(result, dict):
+                    raise ValueError('batch entries must be objects')
+                finished = result.get('finished', time.time())
+                if isinstance(finished, bool) or not isinstance(finished, (int, float)):
+                    raise ValueError('finished must be a timestamp')
+                try:
+                    received.append((result, time.ctime(finished)))
+                except (OverflowError, OSError):
+                    raise ValueError('finished must be a timestamp')
+        except (zlib.error, ValueError) as e:
+            return self.reply(400, {'error': str(e)})
+
+        with self.lock:
+            for result, finished in received:
+                probe = str(result.get('probe', self.client_address[0]))
+                self.latest[probe] = result
+                print('Probe: {}    Download: {}    Upload: {}    Time: {}'.format(
+                    probe, result.get('download'), result.get('upload'), finished))
+        self.reply(200, {'accepted': len(batch)})
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/probes':
+            return self.reply(404, {'error': 'not found'})
+        with self.lock:
+            self.reply(200, self.latest)
+
+
+################################################################################
+# This class writes results to stdout as JSON lines
+################################################################################
+class StdoutSink(object):
+
+    def write(self, result):
+        sys.stdout.write(json.dumps(result, sort_keys=True) + '\n')
+        sys.stdout.flush()
+
+    def close(self):
+        pass
+
+
+################################################################################
+# This class appends results to a file, one formatted result at a time. Once
+# the file would grow past max_bytes it is renamed with a timestamp and a new
+# one started. Old files are compressed and pruned down to the newest backups
+# in a separate thread, so the writer carries on straight away.
+################################################################################
+class RotatingSink(object):
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=10, compress=True):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self.file = None
+        #Archiving threads take turns, so pruning never races a compression
+        self.archiving = threading.Lock()
+
+    def format(self, result):
+        raise NotImplementedError()
+
+    def opened(self):
+        #Called whenever the file is opened, with self.file at its end
+        pass
+
+    def open(self):
+        self.file = open(self.path, 'a', newline='')
+        self.opened()
+
+    def write(self, result):
+        if self.file is None:
+            self.open()
+        data = self.format(result)
+        if self.file.tell() and self.file.tell() + len(data) > self.max_bytes:
+            self.rotate()
+        self.file.write(data)
+        self.file.flush()
+
+    def rotate(self):
+        self.file.close()
+        self.file = None
+        rotated = '{}.{}'.format(self.path, time.strftime('%Y%m%d-%H%M%S'))
+        suffix = 0
+        while os.path.exists(rotated) or os.path.exists(rotated + '.gz'):
+            suffix += 1
+            rotated = '{}.{}-{}'.format(self.path, time.strftime('%Y%m%d-%H%M%S'), suffix)
+        os.rename(self.path, rotated)
+        self.open()
+        run_threaded(lambda: self.archive(rotated))
+
+    def archive(self, rotated):
+        with self.archiving:
+            self._archive(rotated)
+
+    def _archive(self, rotated):
+        try:
+            if self.compress:
+                with open(rotated, 'rb') as source, gzip.open(rotated + '.gz', 'wb') as target:
+                    while True:
+                        chunk = source.read(1024 * 1024)
+                        if not chunk:
+                            break
+                        target.write(chunk)
+                os.remove(rotated)
+            old = sorted(glob.glob(glob.escape(self.path) + '.*'), key=os.path.getmtime)
+            for path in old[:max(0, len(old) - self.backups)]:
+                os.remove(path)
+        except OSError:
+            handle_exception()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class NDJSONSink(RotatingSink):
+
+    def format(self, result):
+        return json.dumps(result, sort_keys=True) + '\n'
+
+
+################################################################################
+# This class writes results as CSV rows under a header of fields. A file
+# that already has a different header is rotated out before writing.
+################################################################################
+class CSVSink(RotatingSink):
+
+    FIELDS = ('id', 'state', 'started', 'finished', 'download', 'upload', 'ping', 'bytes', 'limited', 'validated')
+
+    def __init__(self, path, fields=FIELDS, **kwargs):
+        RotatingSink.__init__(self, path, **kwargs)
+        self.fields = list(fields)
+
+    def header(self):
+        return ','.join(self.fields) + '\r\n'
+
+    def open(self):
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            with open(self.path, newline='') as existing:
+                if existing.readline() != self.header():
+                    RotatingSink.open(self)
+                    self.rotate()
+                    return
+        RotatingSink.open(self)
+
+    def opened(self):
+        if not self.file.tell():
+            self.file.write(self.header())
+
+    def format(self, result):
+        row = io.StringIO()
+        csv.DictWriter(row, self.fields, extrasaction='ignore').writerow(result)
+        return row.getvalue()
+
+
+################################################################################
+# This class hands results to the sinks from a background thread through a
+# bounded queue. Submitting never waits, results that find the queue full
+# are dropped, so a slow disk cannot stall the scheduler.
+################################################################################
+class ResultWriter(threading.Thread):
+
+    def __init__(self, sinks, size=1000):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sinks = sinks
+        self.queue = queue.Queue(size)
+        self.dropped = 0
+
+    def submit(self, result):
+        try:
+            self.queue.put_nowait(result)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            result = self.queue.get()
+            if result is None:
+                break
+            for sink in self.sinks:
+                try:
+                    sink.write(result)
+                except Exception:
+                    handle_exception()
+        for sink in self.sinks:
+            sink.close()
+
+    def close(self):
+        #Write out everything queued, then close the sinks
+        self.queue.put(None)
+        self.join()
+
+
+#Bytes allowed per test and per rolling day, None for no limit
+TEST_BUDGET = None
+DAILY_BUDGET = None
+
+#Rate in Mb/s to pace tests to and seconds to probe unpaced first, None for full speed
+PACE = None
+PACE_PROBE = None
+
+#Latency probe state, None to only run full tests on the regular interval
+LINK_PROBE = None
+
+#Adaptive test schedule, None to test on the fixed interval
+SCHEDULER = None
+
+#Ships results to a collector, None to only print them
+SHIPPER = None
+
+#Writes results to the configured sinks, None to only print them
+WRITER = None
+
+#Statistics of all results since start up
+STATS = StreamingStats()
+
+#The test in flight, so that probes neither measure nor trigger one, and
+#tests are never run in parallel
+TRACKER = TestTracker()
 
 
 ################################################################################
 # This is the main function that will run the speed test and report the results
-# Input: None
+# Input: id from TRACKER.begin, or None to begin a test unless one is in flight
 # Output: None
 ################################################################################
-def main():
+def main(test_id=None):
+
+    if test_id is None:
+        test_id = TRACKER.begin()
+        if test_id is None:
+            return
 
     #Init variables
     downloads = 0
     uploads = 0
+    results = {'state': 'failed'}
+
+    reservation = None
+    budget = TEST_BUDGET
+    if DAILY_BUDGET is not None:
+        reservation = DAILY_BUDGET.reserve(TEST_BUDGET)
+        budget = reservation[1]
+        if not budget:
+            print('Skipped: daily data budget used up    Time: {}'.format(time.ctime()))
+            TRACKER.end(test_id, {'state': 'skipped'})
+            return
 
+    used = 0
+    speedtester = None
     try:
 		#Run the network speed test
-        download, upload = get_speedtest_results()
-        print('Download: {}    Upload: {}    Time: {}'.format(download, upload, time.ctime()))
+        speedtester = build_speedtester(budget, PACE, PACE_PROBE)
+        download, upload, ping, used, limited, validated = get_speedtest_results(speedtester)
+        note = '    (budget limited)' if limited else ''
+        if validated is not None:
+            note += '    (minimum {} Mb/s {})'.format(PACE, 'validated' if validated else 'not validated')
+        print('Download: {}    Upload: {}    Time: {}{}'.format(download, upload, time.ctime(), note))
+
+        results = {'state': 'done', 'download': download, 'upload': upload, 'ping': ping,
+                   'bytes': used, 'limited': limited, 'validated': validated}
+        STATS.add({'download': download, 'upload': upload, 'ping': ping})
+
+        if SCHEDULER is not None:
+            SCHEDULER.record(download, upload, ping)
 
     except:
         handle_exception()
 
+    finally:
+        if reservation is not None:
+            #Charge what a failed run may have moved, not just finished tests
+            if speedtester is not None:
+                used = max(used, speedtester.budget_spent)
+            DAILY_BUDGET.settle(reservation, used)
+        latest = TRACKER.end(test_id, results)
+        if SHIPPER is not None:
+            SHIPPER.submit(latest)
+        if WRITER is not None:
+            WRITER.submit(latest)
+
+################################################################################
+# This function starts a full speed test when the adaptive schedule says so
+# Input: None
+# Output: None
+################################################################################
+def tick():
+
+    if not TRACKER.busy() and SCHEDULER.due():
+        run_threaded(main)
+
+################################################################################
+# This function runs a latency probe, and starts a full speed test as soon as
+# the link turns degraded
+# Input: None
+# Output: None
+################################################################################
+def probe():
+
+    if TRACKER.busy() or not LINK_PROBE.running.acquire(False):
+        return
+
+    try:
+        reason = LINK_PROBE.probe()
+        if reason is None:
+            LINK_PROBE.degraded = False
+            return
+
+        #Only test once for each spell of degradation
+        if not LINK_PROBE.degraded:
+            LINK_PROBE.degraded = True
+            print('Degraded: {}    Time: {}'.format(reason, time.ctime()))
+            run_threaded(main)
+    finally:
+        LINK_PROBE.running.release()
+
+################################################################################
+# This function prints the statistics of the results over the last hour
+# Input: None
+# Output: None
+################################################################################
+def print_stats():
+
+    report = STATS.report()
+    for name in ('download', 'upload', 'ping'):
+        if name in report:
+            hour = report[name]['1h']
+            if hour['count']:
+                print('{} last hour: mean {}  min {}  p50 {}  p90 {}  max {}  ewma {}    Time: {}'.format(
+                    name.capitalize(), hour['mean'], hour['min'], hour['p50'], hour['p90'], hour['max'],
+                    report[name]['ewma'], time.ctime()))
+
 def handle_exception():
     err_type, err_object, err_trace = sys.exc_info()
 
@@ -35,14 +962,13 @@ def handle_exception():
 
 ################################################################################
 # This function performs the speed test for download and upload speeds.
-# It then formats the results in Megabits/second and returns them.
-# Input: None
-# Output: download, upload
+# It then formats the results in Megabits/second and returns them with the ping,
+# the bytes used, whether the byte budget cut the test short and, for paced
+# tests, whether both directions kept up with the pace.
+# Input: speedtest object from build_speedtester
+# Output: download, upload, ping, used, limited, validated
 ################################################################################
-def get_speedtest_results():
-
-    #Create speedtest object
-    speedtester = speedtest.Speedtest()
+def get_speedtest_results(speedtester):
 
     #Call download and upload function to retrieve data
     download = speedtester.download()
@@ -52,15 +978,130 @@ def get_speedtest_results():
     download = round(download/10**6, 2)
     upload = round(upload/10**6, 2)
 
-    return download, upload
+    results = speedtester.results
+    ping = round(results.ping, 2)
+    used = results.bytes_received + results.bytes_sent
+    limited = results.budget.get('limited', False)
+
+    validated = None
+    if results.pacing:
+        validated = all(pacing['validated'] for pacing in results.pacing.values())
+
+    return download, upload, ping, used, limited, validated
+
+################################################################################
+# This function creates the speedtest object for a run, paced to share the
+# link with other traffic
+# Input: budget in bytes, pace in Mb/s and probe in seconds, or None
+# Output: speedtest object
+################################################################################
+def build_speedtester(budget=None, pace=None, probe=None):
+
+    if pace is not None:
+        pace = pace * 10**6
+    return speedtest.Speedtest(budget=budget, pace=pace, pace_probe=probe)
 
 def run_threaded(job_func):
     job_thread = threading.Thread(target=job_func)
     job_thread.start()
 
+################################################################################
+# This function reads the command line options
+# Input: None
+# Output: parsed arguments
+################################################################################
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run a speed test every 30 seconds')
+    parser.add_argument('--test-budget', type=int, default=None,
+                        help='Maximum bytes a single test may transfer')
+    parser.add_argument('--daily-budget', type=int, default=None,
+                        help='Maximum bytes all tests may transfer over a rolling day')
+    parser.add_argument('--pace', type=float, default=None,
+                        help='Pace tests to this many Mb/s to validate a minimum rate')
+    parser.add_argument('--pace-probe', type=float, default=None,
+                        help='Seconds to test unpaced before backing off to --pace')
+    parser.add_argument('--probe-interval', type=float, default=None,
+                        help='Seconds between latency probes that start a full test early on degradation')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Test less often while results are stable, and retest at once on an anomaly')
+    parser.add_argument('--min-interval', type=float, default=30,
+                        help='Shortest seconds between adaptive tests')
+    parser.add_argument('--max-interval', type=float, default=600,
+                        help='Longest seconds between adaptive tests')
+    parser.add_argument('--stats-interval', type=float, default=None,
+                        help='Seconds between printing statistics of the last hour')
+    parser.add_argument('--api-port', type=int, default=None,
+                        help='Serve the HTTP API to start tests and fetch results on this port')
+    parser.add_argument('--api-host', default='127.0.0.1',
+                        help='Address to serve the HTTP API on')
+    parser.add_argument('--collector-url', default=None,
+                        help='Ship results in batches to the collector at this URL, e.g. http://host:8080/ingest')
+    parser.add_argument('--probe-name', default=socket.gethostname(),
+                        help='Name of this probe in shipped results')
+    parser.add_argument('--collect', type=int, default=None, metavar='PORT',
+                        help='Run as a collector accepting results from probes on this port instead of testing')
+    parser.add_argument('--sink', action='append', default=[], metavar='SINK',
+                        help='Write results to stdout, ndjson:PATH or csv:PATH. May be given more than once')
+    parser.add_argument('--rotate-bytes', type=int, default=10 * 1024 * 1024,
+                        help='Size at which result files are rotated')
+    parser.add_argument('--rotate-keep', type=int, default=10,
+                        help='Number of rotated result files to keep')
+    parser.add_argument('--no-compress', dest='compress', action='store_false',
+                        help='Do not gzip rotated result files')
+    parser.add_argument('--probe-history', type=int, default=720,
+                        help='Number of latency probes to keep')
+    return parser.parse_args()
+
 if __name__ == '__main__':
 
-    schedule.every(30).seconds.do(run_threaded, main)
+    args = parse_args()
+
+    if args.collect is not None:
+        collector = ThreadingHTTPServer(('', args.collect), CollectorHandler)
+        collector.daemon_threads = True
+        collector.serve_forever()
+    TEST_BUDGET = args.test_budget
+    PACE = args.pace
+    PACE_PROBE = args.pace_probe
+    if args.daily_budget is not None:
+        DAILY_BUDGET = DailyBudget(args.daily_budget)
+
+    if args.adaptive:
+        SCHEDULER = AdaptiveScheduler(minimum=args.min_interval, maximum=args.max_interval)
+        schedule.every(1).seconds.do(tick)
+    else:
+        schedule.every(30).seconds.do(run_threaded, main)
+
+    if args.sink:
+        sinks = []
+        for sink in args.sink:
+            kind, _, path = sink.partition(':')
+            if kind == 'stdout':
+                sinks.append(StdoutSink())
+            elif kind in ('ndjson', 'csv') and path:
+                sink_class = NDJSONSink if kind == 'ndjson' else CSVSink
+                sinks.append(sink_class(path, max_bytes=args.rotate_bytes, backups=args.rotate_keep,
+                                        compress=args.compress))
+            else:
+                sys.exit('Unknown sink {}, use stdout, ndjson:PATH or csv:PATH'.format(sink))
+        WRITER = ResultWriter(sinks)
+        WRITER.start()
+
+    if args.collector_url is not None:
+        SHIPPER = ResultShipper(args.collector_url, args.probe_name)
+        SHIPPER.start()
+
+    if args.api_port is not None:
+        server = ThreadingHTTPServer((args.api_host, args.api_port), ApiHandler)
+        server.daemon_threads = True
+        run_threaded(server.serve_forever)
+
+    if args.stats_interval is not None:
+        schedule.every(args.stats_interval).seconds.do(print_stats)
+
+    if args.probe_interval is not None:
+        LINK_PROBE = LinkProbe(args.probe_history)
+        schedule.every(args.probe_interval).seconds.do(run_threaded, probe)
 
     while True:
         try:
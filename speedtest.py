@@ -21,9 +21,12 @@ import csv
 import sys
 import math
 import errno
+import select
 import signal
 import socket
+import time
 import timeit
+import tempfile
 import datetime
 import platform
 import threading
@@ -50,9 +53,31 @@ class FakeShutdownEvent(object):
         return False
 
 
+class ProcessShutdownEvent(object):
+    """Class to expose a ``multiprocessing.Event`` through the ``isSet``
+    interface expected by the Thread classes in this module
+    """
+
+    def __init__(self, event):
+        self._event = event
+
+    def isSet(self):
+        return self._event.is_set()
+
+
 # Some global variables we use
 DEBUG = False
 _GLOBAL_DEFAULT_TIMEOUT = object()
+ADDRESS_FAMILIES = {socket.AF_INET: 'IPv4'}
+if socket.has_ipv6:
+    ADDRESS_FAMILIES[socket.AF_INET6] = 'IPv6'
+
+# Seconds worker processes may take to be ready to start transferring
+WORKER_START_TIMEOUT = 60
+
+# Image sizes served for the download test, and body sizes for the upload test
+DOWNLOAD_SIZES = [350, 500, 750, 1000, 1500, 2000, 2500, 3000, 3500, 4000]
+UPLOAD_SIZES = [32768, 65536, 131072, 262144, 524288, 1048576, 7340032]
 
 # Begin import game to handle Python 2 and Python 3
 try:
@@ -85,9 +110,9 @@ except ImportError:
                                 HTTPErrorProcessor, OpenerDirector)
 
 try:
-    from httplib import HTTPConnection, BadStatusLine
+    from httplib import HTTPConnection, BadStatusLine, IncompleteRead
 except ImportError:
-    from http.client import HTTPConnection, BadStatusLine
+    from http.client import HTTPConnection, BadStatusLine, IncompleteRead
 
 try:
     from httplib import HTTPSConnection
@@ -103,9 +128,15 @@ except ImportError:
     FakeSocket = None
 
 try:
-    from Queue import Queue
+    from Queue import Queue, Empty
 except ImportError:
-    from queue import Queue
+    from queue import Queue, Empty
+
+try:
+    import multiprocessing
+    multiprocessing.Barrier
+except (ImportError, AttributeError):
+    multiprocessing = None
 
 try:
     from urlparse import urlparse
@@ -350,8 +381,403 @@ class SpeedtestMissingBestServer(SpeedtestException):
     """get_best_server not called or not able to determine best server"""
 
 
+class SpeedtestSocketOptionError(SpeedtestException):
+    """Requested socket option is invalid or unsupported on this platform"""
+
+
+class DNSCache(object):
+    """Class for caching ``socket.getaddrinfo`` results per ``(host, port)``
+    so that name resolution happens once per session instead of inside
+    every measured request, along with the address family that most
+    recently won a connection race to each host
+
+    Entries are kept for ``ttl`` seconds, a ``ttl`` of ``0`` disables caching.
+    A ``family`` such as ``socket.AF_INET6`` restricts resolution, and so
+    every connection made through the cache, to that address family
+    """
+
+    def __init__(self, ttl=300, family=0):
+        self.ttl = ttl
+        self.address_family = family
+        self._cache = {}
+        self._families = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port, min_ttl=0):
+        """Return the ``getaddrinfo`` results for ``host`` and ``port``,
+        resolving again if the cached entry expires within ``min_ttl``
+        seconds
+        """
+
+        key = (host, port)
+        now = timeit.default_timer()
+
+        self._lock.acquire()
+        try:
+            entry = self._cache.get(key)
+        finally:
+            self._lock.release()
+
+        if entry and entry[0] - now > min_ttl:
+            return entry[1]
+
+        addrinfo = socket.getaddrinfo(host, port, self.address_family,
+                                      socket.SOCK_STREAM)
+        printer('Resolved %s:%s to %r' %
+                (host, port, [res[4][0] for res in addrinfo]), debug=True)
+
+        if self.ttl:
+            self._lock.acquire()
+            try:
+                self._cache[key] = (now + self.ttl, addrinfo)
+            finally:
+                self._lock.release()
+
+        return addrinfo
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._cache.clear()
+            self._families.clear()
+        finally:
+            self._lock.release()
+
+    def family(self, host):
+        """Return the address family that last connected to ``host``"""
+
+        return self._families.get(host)
+
+    def remember_family(self, host, family):
+        """Remember that ``family`` won the last connection race to
+        ``host``
+        """
+
+        self._families[host] = family
+
+
+class SocketOptions(object):
+    """Class for holding socket level tuning applied to every test
+    connection before it is connected:
+
+    ``rcvbuf``/``sndbuf``: ``SO_RCVBUF``/``SO_SNDBUF`` in bytes
+    ``nodelay``: ``TCP_NODELAY``
+    ``quickack``: ``TCP_QUICKACK``
+    ``congestion``: ``TCP_CONGESTION`` algorithm name, such as ``bbr``
+    ``notsent_lowat``: ``TCP_NOTSENT_LOWAT`` in bytes
+
+    Options left as ``None`` are not touched
+    """
+
+    # name, level, option constant name, Linux fallback value
+    OPTIONS = (
+        ('rcvbuf', socket.SOL_SOCKET, 'SO_RCVBUF', None),
+        ('sndbuf', socket.SOL_SOCKET, 'SO_SNDBUF', None),
+        ('nodelay', socket.IPPROTO_TCP, 'TCP_NODELAY', None),
+        ('quickack', socket.IPPROTO_TCP, 'TCP_QUICKACK', 12),
+        ('congestion', socket.IPPROTO_TCP, 'TCP_CONGESTION', 13),
+        ('notsent_lowat', socket.IPPROTO_TCP, 'TCP_NOTSENT_LOWAT', 25),
+    )
+
+    def __init__(self, rcvbuf=None, sndbuf=None, nodelay=None,
+                 quickack=None, congestion=None, notsent_lowat=None):
+        self.requested = {
+            'rcvbuf': rcvbuf,
+            'sndbuf': sndbuf,
+            'nodelay': nodelay,
+            'quickack': quickack,
+            'congestion': congestion,
+            'notsent_lowat': notsent_lowat,
+        }
+        self.effective = {}
+
+        self._options = []
+        for name, level, constant, fallback in self.OPTIONS:
+            value = self.requested[name]
+            if value is None:
+                continue
+            optname = getattr(socket, constant, None)
+            if optname is None:
+                if not sys.platform.startswith('linux') or fallback is None:
+                    raise SpeedtestSocketOptionError(
+                        '%s is not supported on this platform' % constant
+                    )
+                optname = fallback
+            if name == 'congestion':
+                value = value.encode()
+            elif isinstance(value, bool):
+                value = int(value)
+            self._options.append((name, level, optname, value))
+
+    def __len__(self):
+        return len(self._options)
+
+    def apply(self, sock):
+        """Set the requested options on ``sock``"""
+
+        for name, level, optname, value in self._options:
+            sock.setsockopt(level, optname, value)
+
+    def validate(self):
+        """Apply the requested options to a throwaway socket, raising
+        ``SpeedtestSocketOptionError`` if the kernel refuses any of them,
+        and record the values the kernel actually used in ``effective``
+        """
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            for name, level, optname, value in self._options:
+                try:
+                    sock.setsockopt(level, optname, value)
+                    if name == 'congestion':
+                        effective = sock.getsockopt(level, optname, 16)
+                        effective = effective.split('\0'.encode())[0]
+                        self.effective[name] = effective.decode()
+                    else:
+                        self.effective[name] = sock.getsockopt(level,
+                                                               optname)
+                except socket.error:
+                    e = get_exception()
+                    raise SpeedtestSocketOptionError(
+                        'Unable to set %s=%r: %s' %
+                        (name, self.requested[name], e)
+                    )
+        finally:
+            sock.close()
+
+        printer('Socket options: %r' % self.dict(), debug=True)
+
+    def dict(self):
+        """Return dictionary of requested and effective option values"""
+
+        return {
+            'requested': dict((k, v) for k, v in self.requested.items()
+                              if v is not None),
+            'effective': self.effective,
+        }
+
+
+class TLSSessionCache(object):
+    """Class for sharing a single ``ssl.SSLContext`` between all HTTPS
+    connections of a session, and remembering the last TLS session per
+    ``(host, port)`` so that later connections resume it instead of
+    performing a full handshake
+    """
+
+    def __init__(self, context=None):
+        self._context = context
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self.handshakes = 0
+        self.resumed = 0
+
+    def __getstate__(self):
+        # Neither SSLContext nor SSLSession objects can be pickled, a
+        # worker process starts with a fresh context and no sessions
+        return {'handshakes': 0, 'resumed': 0}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    @property
+    def context(self):
+        if self._context is None and hasattr(ssl, 'create_default_context'):
+            self._context = ssl.create_default_context()
+        return self._context
+
+    def get(self, host, port):
+        """Return a session to resume for ``host`` and ``port``, if any"""
+
+        self._lock.acquire()
+        try:
+            return self._sessions.get((host, port))
+        finally:
+            self._lock.release()
+
+    def put(self, host, port, sock):
+        """Remember the session of ``sock``, a connected ``ssl.SSLSocket``"""
+
+        session = getattr(sock, 'session', None)
+        if session is None:
+            return
+        self._lock.acquire()
+        try:
+            self._sessions[(host, port)] = session
+        finally:
+            self._lock.release()
+
+    def handshake(self, sock):
+        """Record whether the handshake on ``sock`` resumed a session"""
+
+        self._lock.acquire()
+        try:
+            self.handshakes += 1
+            if getattr(sock, 'session_reused', False):
+                self.resumed += 1
+        finally:
+            self._lock.release()
+
+    def dict(self):
+        """Return dictionary of handshake counts"""
+
+        return {
+            'handshakes': self.handshakes,
+            'resumed': self.resumed,
+        }
+
+
+class ConnectionPool(object):
+    """Class for holding connections that were opened and warmed ahead of a
+    test, so that handshakes happen outside of the measured window
+
+    Connections are kept per connection class and ``host``, and are handed
+    out once. Connections idle for longer than ``max_idle`` seconds, or
+    closed by the server in the meantime, are discarded
+    """
+
+    def __init__(self, max_idle=30):
+        self.max_idle = max_idle
+        self._connections = {}
+        self._lock = threading.Lock()
+        self._warming = []
+
+    def __getstate__(self):
+        # Sockets cannot be shared with a worker process
+        return {'max_idle': self.max_idle}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def put(self, host, connection):
+        """Add ``connection``, a connected ``HTTPConnection``, for
+        ``host``
+        """
+
+        self._lock.acquire()
+        try:
+            self._connections.setdefault(
+                (connection.__class__, host), []
+            ).append((timeit.default_timer(), connection))
+        finally:
+            self._lock.release()
+
+    def take(self, connection, host):
+        """Return a ready ``connection`` instance for ``host``, or ``None``
+        if there is none
+        """
+
+        while 1:
+            self._lock.acquire()
+            try:
+                try:
+                    stamp, h = self._connections[(connection, host)].pop(0)
+                except (KeyError, IndexError):
+                    return None
+            finally:
+                self._lock.release()
+
+            # An idle keep-alive socket only becomes readable when the
+            # server closes it
+            try:
+                readable = select.select([h.sock], [], [], 0)[0]
+            except (select.error, ValueError, TypeError):
+                readable = True
+            if (timeit.default_timer() - stamp > self.max_idle or
+                    readable):
+                h.close()
+                continue
+            printer('Using warm connection to %s' % host, debug=True)
+            return h
+
+    def warm(self, build_connection, host, path, count, headers=None):
+        """Open ``count`` connections to ``host`` in background threads,
+        each warmed with a keep-alive ``GET`` of ``path``, and add them to
+        the pool
+        """
+
+        def opener():
+            h = build_connection(host)
+            try:
+                h.request('GET', path, headers=headers or {})
+                r = h.getresponse()
+                r.read()
+                if int(r.status) != 200 or r.will_close:
+                    raise SpeedtestHTTPError(r.status)
+            except HTTP_ERRORS + (SpeedtestHTTPError,):
+                e = get_exception()
+                printer('Warming connection to %s failed: %r' % (host, e),
+                        debug=True)
+                h.close()
+                return
+            self.put(host, h)
+
+        for _ in range(count):
+            thread = threading.Thread(target=opener)
+            thread.daemon = True
+            thread.start()
+            self._warming.append(thread)
+
+    def wait(self):
+        """Wait for connections started by ``warm`` to be ready"""
+
+        while self._warming:
+            thread = self._warming.pop(0)
+            while is_alive(thread):
+                thread.join(timeout=0.1)
+
+    def clear(self):
+        """Close all pooled connections"""
+
+        self.wait()
+        self._lock.acquire()
+        try:
+            connections = self._connections
+            self._connections = {}
+        finally:
+            self._lock.release()
+        for pooled in connections.values():
+            for _, h in pooled:
+                h.close()
+
+
+def interleave_addrinfo(addrinfo, preferred=None):
+    """Order ``getaddrinfo`` results alternating between address families,
+    starting with ``preferred`` if given, otherwise with the family of the
+    first result, as described in RFC 8305 section 4
+    """
+
+    families = []
+    by_family = {}
+    for res in addrinfo:
+        if res[0] not in by_family:
+            families.append(res[0])
+            by_family[res[0]] = []
+        by_family[res[0]].append(res)
+
+    if preferred in families:
+        families.remove(preferred)
+        families.insert(0, preferred)
+
+    ordered = []
+    while len(ordered) < len(addrinfo):
+        for family in families:
+            if by_family[family]:
+                ordered.append(by_family[family].pop(0))
+    return ordered
+
+
 def create_connection(address, timeout=_GLOBAL_DEFAULT_TIMEOUT,
-                      source_address=None):
+                      source_address=None, resolver=None,
+                      socket_options=None, delay=0.25):
     """Connect to *address* and return the socket object.
 
     Convenience function.  Connect to *address* (a 2-tuple ``(host,
@@ -362,28 +788,105 @@ def create_connection(address, timeout=_GLOBAL_DEFAULT_TIMEOUT,
     is used.  If *source_address* is set it must be a tuple of (host, port)
     for the socket to bind as a source address before making the connection.
     An host of '' or port 0 tells the OS to use the default.
+    If *resolver* is set it must be a ``DNSCache`` used in place of
+    ``socket.getaddrinfo``. If *socket_options* is set it must be a
+    ``SocketOptions`` applied to the socket before connecting.
 
-    Largely vendored from Python 2.7, modified to work with Python 2.4
+    Addresses are raced in the style of RFC 8305 "Happy Eyeballs": attempts
+    alternate between address families and a new attempt starts every
+    *delay* seconds, or as soon as the previous one fails, until one
+    connects. *timeout* bounds the whole race. The winning family is
+    remembered by *resolver* and tried first next time.
+
+    Originally vendored from Python 2.7
     """
 
     host, port = address
+    if resolver is not None:
+        addrinfo = resolver.resolve(host, port)
+        preferred = resolver.family(host)
+    else:
+        addrinfo = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        preferred = None
+
+    if timeout is _GLOBAL_DEFAULT_TIMEOUT:
+        timeout = socket.getdefaulttimeout()
+    if timeout is not None:
+        timeout = float(timeout)
+        deadline = timeit.default_timer() + timeout
+    else:
+        deadline = None
+
+    queue = interleave_addrinfo(addrinfo, preferred)
+    pending = {}
+    winner = None
     err = None
-    for res in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
-        af, socktype, proto, canonname, sa = res
-        sock = None
-        try:
-            sock = socket.socket(af, socktype, proto)
-            if timeout is not _GLOBAL_DEFAULT_TIMEOUT:
-                sock.settimeout(float(timeout))
-            if source_address:
-                sock.bind(source_address)
-            sock.connect(sa)
-            return sock
-
-        except socket.error:
-            err = get_exception()
-            if sock is not None:
+    next_attempt = 0
+    try:
+        while queue or pending:
+            now = timeit.default_timer()
+            if queue and (not pending or now >= next_attempt):
+                af, socktype, proto, canonname, sa = queue.pop(0)
+                sock = None
+                try:
+                    sock = socket.socket(af, socktype, proto)
+                    if socket_options:
+                        socket_options.apply(sock)
+                    if source_address:
+                        sock.bind(source_address)
+                    sock.setblocking(0)
+                    rc = sock.connect_ex(sa)
+                    if rc == 0:
+                        winner = sock
+                        break
+                    if rc not in (errno.EINPROGRESS, errno.EWOULDBLOCK,
+                                  errno.EAGAIN, 10035):
+                        raise socket.error(rc, os.strerror(rc))
+                    printer('Connecting to %s:%s via %r' % (host, port, sa),
+                            debug=True)
+                    pending[sock] = af
+                    next_attempt = now + delay
+                except socket.error:
+                    err = get_exception()
+                    if sock is not None:
+                        sock.close()
+                continue
+
+            if queue:
+                wait = max(0, next_attempt - now)
+            else:
+                wait = None
+            if deadline is not None:
+                if now >= deadline:
+                    raise socket.timeout('timed out')
+                if wait is None:
+                    wait = deadline - now
+                else:
+                    wait = min(wait, deadline - now)
+
+            socks = list(pending)
+            _, writable, failed = select.select([], socks, socks, wait)
+            for sock in writable + failed:
+                if sock not in pending:
+                    continue
+                af = pending.pop(sock)
+                rc = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if rc == 0 and sock not in failed:
+                    winner = sock
+                    break
+                err = socket.error(rc, os.strerror(rc))
                 sock.close()
+            if winner is not None:
+                break
+    finally:
+        for sock in pending:
+            sock.close()
+
+    if winner is not None:
+        winner.settimeout(timeout)
+        if resolver is not None:
+            resolver.remember_family(host, winner.family)
+        return winner
 
     if err is not None:
         raise err
@@ -398,26 +901,29 @@ class SpeedtestHTTPConnection(HTTPConnection):
     def __init__(self, *args, **kwargs):
         source_address = kwargs.pop('source_address', None)
         timeout = kwargs.pop('timeout', 10)
+        resolver = kwargs.pop('resolver', None)
+        socket_options = kwargs.pop('socket_options', None)
 
         HTTPConnection.__init__(self, *args, **kwargs)
 
         self.source_address = source_address
         self.timeout = timeout
+        self.resolver = resolver
+        self.socket_options = socket_options
 
     def connect(self):
         """Connect to the host and port specified in __init__."""
-        try:
-            self.sock = socket.create_connection(
-                (self.host, self.port),
-                self.timeout,
-                self.source_address
-            )
-        except (AttributeError, TypeError):
-            self.sock = create_connection(
-                (self.host, self.port),
-                self.timeout,
-                self.source_address
-            )
+        # With a resolver the connection is made by cached address,
+        # ``self.host`` is left untouched so that the Host header and SNI
+        # are still correct
+        self.sock = create_connection(
+            (self.host, self.port),
+            self.timeout,
+            self.source_address,
+            resolver=self.resolver,
+            socket_options=self.socket_options
+        )
+        track_socket(self.sock)
 
 
 if HTTPSConnection:
@@ -429,11 +935,21 @@ if HTTPSConnection:
         def __init__(self, *args, **kwargs):
             source_address = kwargs.pop('source_address', None)
             timeout = kwargs.pop('timeout', 10)
+            resolver = kwargs.pop('resolver', None)
+            socket_options = kwargs.pop('socket_options', None)
+            tls_cache = kwargs.pop('tls_cache', None)
+
+            if (tls_cache is not None and not kwargs.get('context') and
+                    tls_cache.context is not None):
+                kwargs['context'] = tls_cache.context
 
             HTTPSConnection.__init__(self, *args, **kwargs)
 
             self.timeout = timeout
             self.source_address = source_address
+            self.resolver = resolver
+            self.socket_options = socket_options
+            self.tls_cache = tls_cache
 
         def connect(self):
             "Connect to a host on a given (SSL) port."
@@ -445,7 +961,14 @@ if HTTPSConnection:
                     kwargs = {}
                     if hasattr(ssl, 'SSLContext'):
                         kwargs['server_hostname'] = self.host
+                    if (self.tls_cache is not None and
+                            hasattr(ssl, 'SSLSession')):
+                        session = self.tls_cache.get(self.host, self.port)
+                        if session is not None:
+                            kwargs['session'] = session
                     self.sock = self._context.wrap_socket(self.sock, **kwargs)
+                    if self.tls_cache is not None:
+                        self.tls_cache.handshake(self.sock)
                 except AttributeError:
                     self.sock = ssl.wrap_socket(self.sock)
                     try:
@@ -466,41 +989,114 @@ if HTTPSConnection:
                     'This version of Python does not support HTTPS/SSL '
                     'functionality'
                 )
+            track_socket(self.sock)
+
+        def getresponse(self, *args, **kwargs):
+            # TLS 1.3 session tickets only arrive after the handshake, so
+            # the session is stored once the response headers have been read
+            sock = self.sock
+            response = HTTPSConnection.getresponse(self, *args, **kwargs)
+            if self.tls_cache is not None and sock is not None:
+                self.tls_cache.put(self.host, self.port, sock)
+            return response
+
 
+def track_socket(sock):
+    """Remember ``sock`` as the socket of the calling ``TransferThread``, if
+    any, so that a ``StallWatchdog`` can abort it
 
-def _build_connection(connection, source_address, timeout, context=None):
+    A thread that was aborted while it had no socket, such as while still
+    connecting, has the new socket shut down at once
+    """
+
+    thread = threading.current_thread()
+    if isinstance(thread, TransferThread):
+        thread.sock = sock
+        if thread.aborted:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except (socket.error, ValueError):
+                pass
+
+
+def _build_connection(connection, source_address, timeout, context=None,
+                      resolver=None, socket_options=None, tls_cache=None,
+                      pool=None):
     """Cross Python 2.4 - Python 3 callable to build an ``HTTPConnection`` or
-    ``HTTPSConnection`` with the args we need
+    ``HTTPSConnection`` with the args we need, or to hand out an already
+    connected one from a ``ConnectionPool``
 
     Called from ``http(s)_open`` methods of ``SpeedtestHTTPHandler`` or
     ``SpeedtestHTTPSHandler``
     """
     def inner(host, **kwargs):
-        kwargs.update({
-            'source_address': source_address,
-            'timeout': timeout
-        })
-        if context:
-            kwargs['context'] = context
-        return connection(host, **kwargs)
+        h = None
+        if pool is not None:
+            h = pool.take(connection, host)
+        if h is None:
+            kwargs.update({
+                'source_address': source_address,
+                'timeout': timeout,
+                'resolver': resolver,
+                'socket_options': socket_options
+            })
+            if context:
+                kwargs['context'] = context
+            if tls_cache is not None:
+                kwargs['tls_cache'] = tls_cache
+            h = connection(host, **kwargs)
+        else:
+            track_socket(h.sock)
+        return h
     return inner
 
 
+def connection_factory(url, source_address=None, timeout=10, resolver=None,
+                       socket_options=None, tls_cache=None, pool=None):
+    """Return a callable that builds a ``SpeedtestHTTPConnection`` or
+    ``SpeedtestHTTPSConnection``, depending on the scheme of ``url``, for
+    engines that drive connections themselves rather than through an
+    ``OpenerDirector``
+    """
+
+    if source_address:
+        source_address_tuple = (source_address, 0)
+    else:
+        source_address_tuple = None
+
+    if urlparse(url)[0] == 'https':
+        return _build_connection(SpeedtestHTTPSConnection,
+                                 source_address_tuple, timeout,
+                                 resolver=resolver,
+                                 socket_options=socket_options,
+                                 tls_cache=tls_cache, pool=pool)
+    return _build_connection(SpeedtestHTTPConnection, source_address_tuple,
+                             timeout, resolver=resolver,
+                             socket_options=socket_options, pool=pool)
+
+
 class SpeedtestHTTPHandler(AbstractHTTPHandler):
     """Custom ``HTTPHandler`` that can build a ``HTTPConnection`` with the
     args we need for ``source_address`` and ``timeout``
     """
-    def __init__(self, debuglevel=0, source_address=None, timeout=10):
+    def __init__(self, debuglevel=0, source_address=None, timeout=10,
+                 resolver=None, socket_options=None, pool=None):
         AbstractHTTPHandler.__init__(self, debuglevel)
         self.source_address = source_address
         self.timeout = timeout
+        self.resolver = resolver
+        self.socket_options = socket_options
+        self.pool = pool
 
     def http_open(self, req):
         return self.do_open(
             _build_connection(
                 SpeedtestHTTPConnection,
                 self.source_address,
-                self.timeout
+                self.timeout,
+                resolver=self.resolver,
+                socket_options=self.socket_options,
+                pool=self.pool
             ),
             req
         )
@@ -513,11 +1109,16 @@ class SpeedtestHTTPSHandler(AbstractHTTPHandler):
     args we need for ``source_address`` and ``timeout``
     """
     def __init__(self, debuglevel=0, context=None, source_address=None,
-                 timeout=10):
+                 timeout=10, resolver=None, socket_options=None,
+                 tls_cache=None, pool=None):
         AbstractHTTPHandler.__init__(self, debuglevel)
         self._context = context
         self.source_address = source_address
         self.timeout = timeout
+        self.resolver = resolver
+        self.socket_options = socket_options
+        self.tls_cache = tls_cache
+        self.pool = pool
 
     def https_open(self, req):
         return self.do_open(
@@ -526,6 +1127,10 @@ class SpeedtestHTTPSHandler(AbstractHTTPHandler):
                 self.source_address,
                 self.timeout,
                 context=self._context,
+                resolver=self.resolver,
+                socket_options=self.socket_options,
+                tls_cache=self.tls_cache,
+                pool=self.pool
             ),
             req
         )
@@ -533,10 +1138,13 @@ class SpeedtestHTTPSHandler(AbstractHTTPHandler):
     https_request = AbstractHTTPHandler.do_request_
 
 
-def build_opener(source_address=None, timeout=10):
+def build_opener(source_address=None, timeout=10, resolver=None,
+                 socket_options=None, tls_cache=None, pool=None):
     """Function similar to ``urllib2.build_opener`` that will build
     an ``OpenerDirector`` with the explicit handlers we want,
-    ``source_address`` for binding, ``timeout`` and our custom
+    ``source_address`` for binding, ``timeout``, an optional ``DNSCache``
+    ``resolver``, optional ``SocketOptions``, an optional
+    ``TLSSessionCache``, an optional ``ConnectionPool`` and our custom
     `User-Agent`
     """
 
@@ -552,9 +1160,12 @@ def build_opener(source_address=None, timeout=10):
     handlers = [
         ProxyHandler(),
         SpeedtestHTTPHandler(source_address=source_address_tuple,
-                             timeout=timeout),
+                             timeout=timeout, resolver=resolver,
+                             socket_options=socket_options, pool=pool),
         SpeedtestHTTPSHandler(source_address=source_address_tuple,
-                              timeout=timeout),
+                              timeout=timeout, resolver=resolver,
+                              socket_options=socket_options,
+                              tls_cache=tls_cache, pool=pool),
         HTTPDefaultErrorHandler(),
         HTTPRedirectHandler(),
         HTTPErrorProcessor()
@@ -606,6 +1217,17 @@ def get_exception():
     return sys.exc_info()[1]
 
 
+def etree_iter(element, tag):
+    """Return an iterator over ``tag`` elements below ``element``, using
+    ``getiterator`` on ElementTree versions without ``iter``
+    """
+
+    try:
+        return element.iter(tag)
+    except AttributeError:
+        return element.getiterator(tag)
+
+
 def distance(origin, destination):
     """Determine distance between 2 sets of [lat,lon] in km"""
 
@@ -745,140 +1367,1385 @@ def do_nothing(*args, **kwargs):
     pass
 
 
-class HTTPDownloader(threading.Thread):
-    """Thread class for retrieving a URL"""
+def is_alive(thread):
+    """Helper function to work with py2.4-py3 for checking whether a
+    thread or process is still running
+    """
+    try:
+        return thread.is_alive()
+    except AttributeError:
+        return thread.isAlive()
 
-    def __init__(self, i, request, start, timeout, opener=None,
-                 shutdown_event=None):
-        threading.Thread.__init__(self)
-        self.request = request
-        self.result = [0]
-        self.starttime = start
-        self.timeout = timeout
-        self.i = i
-        if opener:
-            self._opener = opener.open
-        else:
-            self._opener = urlopen
 
-        if shutdown_event:
-            self._shutdown_event = shutdown_event
-        else:
-            self._shutdown_event = FakeShutdownEvent()
+def run_transfers(requests, build_thread, concurrency, callback=do_nothing,
+                  started=None):
+    """Run a thread built by ``build_thread(i, request)`` for each of
+    ``requests`` using a producer/consumer pair, so that no more than
+    ``concurrency`` threads are queued at any one time
 
-    def run(self):
-        try:
-            if (timeit.default_timer() - self.starttime) <= self.timeout:
-                f = self._opener(self.request)
-                while (not self._shutdown_event.isSet() and
-                        (timeit.default_timer() - self.starttime) <=
-                        self.timeout):
-                    self.result.append(len(f.read(10240)))
-                    if self.result[-1] == 0:
-                        break
-                f.close()
-        except IOError:
-            pass
+    Each thread is appended to ``started``, if given, as soon as it starts
 
+    Returns the list of finished threads
+    """
 
-class HTTPUploaderData(object):
-    """File like object to improve cutting off the upload once the timeout
-    has been reached
+    request_count = len(requests)
+    finished = []
+
+    def producer(q):
+        for i, request in enumerate(requests):
+            thread = build_thread(i, request)
+            thread.start()
+            if started is not None:
+                started.append(thread)
+            q.put(thread, True)
+            callback(i, request_count, start=True)
+
+    def consumer(q):
+        while len(finished) < request_count:
+            thread = q.get(True)
+            while is_alive(thread):
+                thread.join(timeout=0.1)
+            finished.append(thread)
+            callback(thread.i, request_count, end=True)
+
+    q = Queue(concurrency)
+    prod_thread = threading.Thread(target=producer, args=(q,))
+    cons_thread = threading.Thread(target=consumer, args=(q,))
+    prod_thread.start()
+    cons_thread.start()
+    while is_alive(prod_thread):
+        prod_thread.join(timeout=0.1)
+    while is_alive(cons_thread):
+        cons_thread.join(timeout=0.1)
+
+    return finished
+
+
+def download_size_bytes(size):
+    """Approximate number of bytes in the ``randomNxN.jpg`` image of
+    ``size`` pixels square
     """
 
-    def __init__(self, length, start, timeout, shutdown_event=None):
-        self.length = length
-        self.start = start
-        self.timeout = timeout
+    return 2 * size * size
 
-        if shutdown_event:
-            self._shutdown_event = shutdown_event
-        else:
-            self._shutdown_event = FakeShutdownEvent()
 
-        self._data = None
+def size_ladder(rate, length, threads, sizes, size_bytes=int,
+                per_stream=4):
+    """Pick from ``sizes`` the request sizes, and the count of each, for a
+    test of ``length`` seconds over ``threads`` streams on a link of
+    ``rate`` bits per second
 
-        self.total = [0]
+    Each stream gets about ``per_stream`` requests, so that slow links do not
+    wait on huge files and fast links do not churn through tiny ones, and
+    the requests hold half as many bytes again as the link should move in
+    ``length``, so that streams never run dry. ``size_bytes`` converts a
+    size to its number of bytes
 
-    def pre_allocate(self):
-        chars = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
-        multiplier = int(round(int(self.length) / 36.0))
-        IO = BytesIO or StringIO
-        try:
-            self._data = IO(
-                ('content1=%s' %
-                 (chars * multiplier)[0:int(self.length) - 9]
-                 ).encode()
-            )
-        except MemoryError:
-            raise SpeedtestCLIError(
-                'Insufficient memory to pre-allocate upload data. Please '
-                'use --no-pre-allocate'
-            )
+    Returns a tuple of the sizes and the count of each
+    """
 
-    @property
-    def data(self):
-        if not self._data:
-            self.pre_allocate()
-        return self._data
+    needed = rate / 8.0 * length * 1.5
+    target = max(needed / (threads * per_stream), 1)
 
-    def read(self, n=10240):
-        if ((timeit.default_timer() - self.start) <= self.timeout and
-                not self._shutdown_event.isSet()):
-            chunk = self.data.read(n)
-            self.total.append(len(chunk))
-            return chunk
-        else:
-            raise SpeedtestUploadTimeout()
+    ladder = [size for size in sizes
+              if target / 2 <= size_bytes(size) <= target * 2]
+    if not ladder:
+        ladder = [min(sizes, key=lambda size: abs(
+            math.log(size_bytes(size) / float(target))
+        ))]
 
-    def __len__(self):
-        return self.length
+    count = int(math.ceil(needed / sum([size_bytes(size)
+                                        for size in ladder])))
+    count = max(count, int(math.ceil(threads / float(len(ladder)))), 1)
+    return ladder, count
 
 
-class HTTPUploader(threading.Thread):
-    """Thread class for putting a URL"""
+def stream_stats(threads):
+    """Summarize the throughput of each finished ``TransferThread`` in
+    ``threads``
 
-    def __init__(self, i, request, start, size, timeout, opener=None,
-                 shutdown_event=None):
-        threading.Thread.__init__(self)
-        self.request = request
-        self.request.data.start = self.starttime = start
-        self.size = size
-        self.result = None
-        self.timeout = timeout
-        self.i = i
+    Returns a dictionary holding ``streams``, a compact list of
+    ``[start, end, bytes, rate]`` per stream, with times in seconds from the
+    start of the first stream and the rate in bits per second, along with
+    the ``min``, ``max`` and ``mean`` stream rate and Jain's fairness index
+    of the stream rates, which is ``1`` when every stream got the same rate
+    and approaches ``1 / count`` as a single stream dominates
+    """
 
-        if opener:
-            self._opener = opener.open
-        else:
-            self._opener = urlopen
+    threads = [thread for thread in threads
+               if thread.started is not None and thread.ended is not None]
+    if not threads:
+        return {}
+
+    origin = min(thread.started for thread in threads)
+    streams = []
+    for thread in threads:
+        duration = thread.ended - thread.started
+        transferred = thread.transferred
+        # Streams that started after the test length was reached never
+        # transferred anything, and are not streams at all
+        if not transferred and duration < 0.01:
+            continue
+        rate = 0
+        if duration > 0:
+            rate = transferred * 8.0 / duration
+        streams.append([round(thread.started - origin, 3),
+                        round(thread.ended - origin, 3),
+                        transferred, round(rate, 1)])
+
+    rates = [stream[3] for stream in streams]
+    if not rates:
+        return {}
+
+    squares = sum([rate * rate for rate in rates])
+    fairness = None
+    if squares:
+        fairness = round(sum(rates) ** 2 / (len(rates) * squares), 4)
+
+    return {
+        'count': len(rates),
+        'min': min(rates),
+        'max': max(rates),
+        'mean': round(sum(rates) / len(rates), 1),
+        'fairness': fairness,
+        'streams': streams,
+    }
+
+
+class StallWatchdog(threading.Thread):
+    """Thread class watching the transfer threads returned by
+    ``get_threads()``, aborting any that made no progress for ``interval``
+    seconds and starting the replacement built by
+    ``replace(thread, server)``
+
+    ``server`` cycles through ``servers`` if given, otherwise it is
+    ``None`` and the replacement goes to the same server. Replacements are
+    appended to the list of watched threads, and are watched in turn
+
+    ``stalls`` holds a dictionary per aborted stream
+    """
+
+    def __init__(self, get_threads, replace, interval=5, servers=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.get_threads = get_threads
+        self.replace = replace
+        self.interval = interval
+        self.servers = servers or []
+        self.stalls = []
+        self._progress = {}
+        self._done = threading.Event()
+
+    def check(self):
+        now = timeit.default_timer()
+        threads = self.get_threads()
+        for thread in list(threads):
+            if (thread.started is None or thread.ended is not None or
+                    thread.aborted):
+                continue
+            transferred = thread.transferred
+            seen = self._progress.get(thread)
+            if seen is None or seen[0] != transferred:
+                self._progress[thread] = (transferred, now)
+                continue
+            if now - seen[1] < self.interval:
+                continue
+
+            thread.abort()
+            server = None
+            if self.servers:
+                server = self.servers[len(self.stalls) % len(self.servers)]
+            stall = {
+                'stream': thread.i,
+                'elapsed': round(now - self.starttime, 3),
+                'bytes': transferred,
+                'replacement': server and server['url'],
+            }
+            printer('Stream %(stream)s stalled after %(bytes)s bytes' %
+                    stall, debug=True)
+            self.stalls.append(stall)
+
+            replacement = self.replace(thread, server)
+            if replacement is not None:
+                replacement.start()
+                threads.append(replacement)
+
+    def run(self):
+        self.starttime = timeit.default_timer()
+        while 1:
+            self._done.wait(min(self.interval / 4.0, 0.5))
+            if self._done.isSet():
+                break
+            self.check()
+
+    def finish(self):
+        """Stop watching, and wait for any replacement streams to finish"""
+
+        self._done.set()
+        while is_alive(self):
+            self.join(timeout=0.1)
+        for thread in self.get_threads():
+            while is_alive(thread):
+                thread.join(timeout=0.1)
+
+
+def retarget_request(request, url, server_url):
+    """Return a copy of ``request``, sent to the speedtest.net server at
+    ``server_url`` instead of the one at ``url``
+    """
+
+    return Request(
+        request.get_full_url().replace(os.path.dirname(url),
+                                       os.path.dirname(server_url), 1),
+        data=request.data,
+        headers=dict(request.header_items())
+    )
+
+
+class TransferSampler(threading.Thread):
+    """Thread class for sampling the combined ``transferred`` byte count of
+    the transfer threads returned by ``get_threads()`` every ``interval``
+    seconds
+
+    ``samples`` holds ``(elapsed, bytes)`` pairs, cumulative since the
+    sampler started
+    """
+
+    def __init__(self, get_threads, interval=0.5):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.get_threads = get_threads
+        self.interval = interval
+        self.samples = []
+        self._done = threading.Event()
+
+    def sample(self):
+        total = 0
+        for thread in list(self.get_threads()):
+            total += thread.transferred
+        self.samples.append(
+            (round(timeit.default_timer() - self.starttime, 3), total)
+        )
+
+    def run(self):
+        self.starttime = timeit.default_timer()
+        while 1:
+            self._done.wait(self.interval)
+            if self._done.isSet():
+                break
+            self.sample()
+
+    def finish(self):
+        """Stop sampling, and take a last sample"""
+
+        self._done.set()
+        while is_alive(self):
+            self.join(timeout=0.1)
+        self.sample()
+
+    def rates(self):
+        """Return ``(elapsed, bits per second)`` pairs for each interval
+        between samples
+        """
+
+        rates = []
+        previous = (0, 0)
+        for sample in self.samples:
+            if sample[0] > previous[0]:
+                rates.append((sample[0], ((sample[1] - previous[1]) * 8.0 /
+                                          (sample[0] - previous[0]))))
+            previous = sample
+        return rates
+
+
+class ByteBudget(object):
+    """Class for a number of bytes shared by every stream of a test, which
+    streams take from ahead of each read or write, so that together they
+    never transfer more than ``limit`` bytes of response or request body
+
+    With ``shared`` the count is kept in shared memory, so that the streams
+    of all worker processes draw from the same budget
+    """
+
+    def __init__(self, limit, shared=False):
+        self.limit = int(limit)
+        if shared:
+            self._used = multiprocessing.Array('d', 1, lock=False)
+            self._lock = multiprocessing.Lock()
+        else:
+            self._used = [0]
+            self._lock = threading.Lock()
+
+    @property
+    def used(self):
+        return int(self._used[0])
+
+    @property
+    def exhausted(self):
+        return self.used >= self.limit
+
+    def take(self, size):
+        """Take up to ``size`` bytes from the budget, returning the number
+        granted, ``0`` once the budget is exhausted
+        """
+
+        self._lock.acquire()
+        try:
+            granted = min(size, self.limit - int(self._used[0]))
+            if granted <= 0:
+                return 0
+            self._used[0] += granted
+            return granted
+        finally:
+            self._lock.release()
+
+    def refund(self, size):
+        """Return ``size`` bytes that were taken but not transferred"""
+
+        if size <= 0:
+            return
+        self._lock.acquire()
+        try:
+            self._used[0] -= size
+        finally:
+            self._lock.release()
+
+
+class TokenBucket(object):
+    """Class for pacing every stream of a session to a combined ``rate`` in
+    bits per second. Streams take tokens ahead of each read or write, and
+    wait until the bucket has refilled enough to cover them, no more than
+    ``burst`` bytes at a time
+
+    After ``reset`` with a ``probe`` in seconds, everything is let through
+    for that long from the first take, before backing off to ``rate``
+
+    With ``shared`` the state is kept in shared memory, so that the streams
+    of all worker processes are paced together
+    """
+
+    def __init__(self, rate, burst=None, shared=False):
+        self.rate = float(rate)
+        if burst is None:
+            # 50ms at the rate, and no less than a typical read
+            burst = max(16384, int(self.rate / 8 * 0.05))
+        self.burst = int(burst)
+        # Time the stream after the last one taken may start, time of the
+        # first take, probe length, end of the probe, bytes taken during
+        # the probe and bytes taken in total
+        if shared:
+            self._state = multiprocessing.Array('d', 6, lock=False)
+            self._lock = multiprocessing.Lock()
+        else:
+            self._state = [0.0] * 6
+            self._lock = threading.Lock()
+
+    def reset(self, probe=None):
+        """Clear the bucket for a new test, letting everything through for
+        the first ``probe`` seconds of it
+        """
+
+        self._lock.acquire()
+        try:
+            for i in range(len(self._state)):
+                self._state[i] = 0.0
+            self._state[2] = probe or 0.0
+        finally:
+            self._lock.release()
+
+    def take(self, size):
+        """Wait until ``size`` more bytes may pass at the rate"""
+
+        interval = 8.0 / self.rate
+        self._lock.acquire()
+        try:
+            now = timeit.default_timer()
+            state = self._state
+            if not state[1]:
+                state[1] = now
+                state[3] = now + state[2]
+            state[5] += size
+            if now < state[3]:
+                state[4] += size
+                return
+            state[0] = max(state[0], now) + size * interval
+            delay = state[0] - now - self.burst * interval
+        finally:
+            self._lock.release()
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def refund(self, size):
+        """Return ``size`` bytes that were taken but not transferred"""
+
+        if size <= 0:
+            return
+        self._lock.acquire()
+        try:
+            state = self._state
+            if timeit.default_timer() < state[3]:
+                state[4] -= size
+            else:
+                state[0] -= size * 8.0 / self.rate
+            state[5] -= size
+        finally:
+            self._lock.release()
+
+    def measured(self):
+        """Return the rate in bits per second that passed the bucket since
+        the first take, and the rate during the probe or ``None`` without
+        one
+        """
+
+        self._lock.acquire()
+        try:
+            now = timeit.default_timer()
+            first, probe, probe_end, probed, taken = self._state[1:6]
+        finally:
+            self._lock.release()
+
+        if not first or now <= first:
+            return 0.0, None
+        rate = taken * 8.0 / (now - first)
+        if not probe:
+            return rate, None
+        return rate, probed * 8.0 / max(min(now, probe_end) - first, 1e-6)
+
+
+class TransferThread(threading.Thread):
+    """Base thread class for a single download or upload stream, recording
+    when the stream started and ended around ``transfer``
+
+    Subclasses implement ``transfer`` and a ``transferred`` byte count
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.started = None
+        self.ended = None
+        self.sock = None
+        self.aborted = False
+        self.budget = None
+        self.pacer = None
+
+    def run(self):
+        self.started = timeit.default_timer()
+        try:
+            self.transfer()
+        finally:
+            self.ended = timeit.default_timer()
+
+    def transfer(self):
+        raise NotImplementedError()
+
+    def _grant(self, size, whole=False):
+        """Return how many of the next ``size`` bytes the stream may
+        transfer under its ``ByteBudget``, once its ``TokenBucket`` lets
+        them through
+
+        Unless ``whole``, a paced stream is granted at most a burst at a time
+        """
+
+        if self.pacer is not None and not whole:
+            size = min(size, self.pacer.burst)
+        if self.budget is not None:
+            size = self.budget.take(size)
+        if size and self.pacer is not None:
+            self.pacer.take(size)
+        return size
+
+    def _refund(self, granted, transferred):
+        if self.budget is not None:
+            self.budget.refund(granted - transferred)
+        if self.pacer is not None:
+            self.pacer.refund(granted - transferred)
+
+    def abort(self):
+        """Abort the stream from another thread, by shutting down the socket
+        of its current connection so that any blocking read or write on it
+        returns, even after ``urllib`` has handed the socket to the response
+        """
+
+        self.aborted = True
+        sock = self.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except (socket.error, ValueError):
+                pass
+
+
+class HTTPDownloader(TransferThread):
+    """Thread class for retrieving a URL"""
+
+    def __init__(self, i, request, start, timeout, opener=None,
+                 shutdown_event=None, budget=None, pacer=None):
+        TransferThread.__init__(self)
+        self.request = request
+        self.result = [0]
+        self.starttime = start
+        self.timeout = timeout
+        self.i = i
+        self.budget = budget
+        self.pacer = pacer
+        if opener:
+            self._opener = opener.open
+        else:
+            self._opener = urlopen
 
         if shutdown_event:
             self._shutdown_event = shutdown_event
         else:
             self._shutdown_event = FakeShutdownEvent()
 
-    def run(self):
+    def transfer(self):
+        try:
+            if ((timeit.default_timer() - self.starttime) <= self.timeout and
+                    not self.aborted):
+                f = self._opener(self.request)
+                while (not self._shutdown_event.isSet() and
+                        not self.aborted and
+                        (timeit.default_timer() - self.starttime) <=
+                        self.timeout):
+                    granted = self._grant(10240)
+                    if not granted:
+                        break
+                    received = len(f.read(granted))
+                    self._refund(granted, received)
+                    if received == 0:
+                        break
+                    self.result[0] += received
+                f.close()
+        except (IOError, IncompleteRead):
+            pass
+
+    @property
+    def transferred(self):
+        """Number of bytes received so far"""
+        return self.result[0]
+
+
+def upload_payload(length):
+    """Return the upload body of ``length`` bytes"""
+
+    length = int(length)
+    chars = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    multiplier = int(math.ceil(length / 36.0))
+    try:
+        return ('content1=%s' % (chars * multiplier)[0:length - 9]).encode()
+    except MemoryError:
+        raise SpeedtestCLIError(
+            'Insufficient memory to pre-allocate upload data. Please '
+            'use --no-pre-allocate'
+        )
+
+
+def upload_payload_slice(length, start, end):
+    """Return bytes ``start`` to ``end`` of the upload body of ``length``
+    bytes, without building the rest of it
+    """
+
+    prefix = 'content1='
+    chars = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    end = min(end, int(length))
+    parts = []
+    if start < len(prefix):
+        parts.append(prefix[start:end])
+        start = len(prefix)
+    if start < end:
+        offset = (start - len(prefix)) % len(chars)
+        count = end - start
+        repeats = (offset + count) // len(chars) + 1
+        parts.append((chars * repeats)[offset:offset + count])
+    return ''.join(parts).encode()
+
+
+class UploadPayloads(object):
+    """Class for sharing the immutable upload body of each size between
+    every request of a test, freed along with the test
+    """
+
+    def __init__(self):
+        self._payloads = {}
+        self._lock = threading.Lock()
+
+    def get(self, length):
+        length = int(length)
+        self._lock.acquire()
+        try:
+            try:
+                return self._payloads[length]
+            except KeyError:
+                payload = self._payloads[length] = upload_payload(length)
+                return payload
+        finally:
+            self._lock.release()
+
+
+def content_length(headers):
+    """Return the ``Content-Length`` from a dictionary of lower cased
+    headers, or ``None`` if it is missing or invalid
+    """
+
+    try:
+        return int(headers['content-length'])
+    except (KeyError, ValueError):
+        return None
+
+
+class RawHTTPDownloader(TransferThread):
+    """Thread class for retrieving a URL over a bare socket
+
+    The GET is written directly, only the status line and headers are
+    parsed, and the body is drained with ``recv_into`` into a buffer that is
+    reused for the life of the thread
+    """
+
+    def __init__(self, i, request, start, timeout, build_connection,
+                 buffer_size=65536, shutdown_event=None, budget=None,
+                 pacer=None):
+        TransferThread.__init__(self)
+        self.request = request
+        self.result = [0]
+        self.starttime = start
+        self.timeout = timeout
+        self.i = i
+        self.budget = budget
+        self.pacer = pacer
+        self._build_connection = build_connection
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+
+        if shutdown_event:
+            self._shutdown_event = shutdown_event
+        else:
+            self._shutdown_event = FakeShutdownEvent()
+
+    def _running(self):
+        return (not self._shutdown_event.isSet() and not self.aborted and
+                (self.budget is None or not self.budget.exhausted) and
+                (timeit.default_timer() - self.starttime) <= self.timeout)
+
+    def _get(self, sock, request, keep_alive=False):
+        """Write a GET for ``request`` to ``sock``"""
+
+        urlparts = urlparse(request.get_full_url())
+        path = urlparts[2]
+        if urlparts[4]:
+            path = '%s?%s' % (path, urlparts[4])
+        lines = ['GET %s HTTP/1.1' % path, 'Host: %s' % urlparts[1]]
+        for header, value in request.header_items():
+            lines.append('%s: %s' % (header, value))
+        lines.extend([
+            'Accept-Encoding: identity',
+            'Connection: %s' % ('close', 'keep-alive')[keep_alive],
+            '',
+            '',
+        ])
+        sock.sendall('\r\n'.join(lines).encode())
+
+    def _read_head(self, sock, pending):
+        """Read the status line and headers of a response, of which
+        ``pending`` has already been read, returning the status code, a
+        dictionary of lower cased headers and any body bytes read past the
+        headers
+        """
+
+        head = pending
+        while 1:
+            end = head.find('\r\n\r\n'.encode())
+            if end != -1:
+                break
+            received = sock.recv_into(self._buffer)
+            if not received:
+                raise BadStatusLine('')
+            head += self._view[:received].tobytes()
+
+        lines = head[:end].decode('iso-8859-1').split('\r\n')
+        try:
+            status = int(lines[0].split()[1])
+        except (IndexError, ValueError):
+            raise BadStatusLine(lines[0])
+
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        return status, headers, head[end + 4:]
+
+    def _drain(self, sock, length, body, count=True):
+        """Read the remainder of a body of ``length`` bytes, or until EOF
+        if ``length`` is ``None``, of which ``body`` has already been read.
+        Returns any bytes read past the end of the body
+        """
+
+        if length is None:
+            counted = len(body)
+        else:
+            counted = min(len(body), length)
+        if count:
+            granted = self._grant(counted, whole=True)
+            if granted < counted:
+                self.result[0] += granted
+                return ''.encode()
+            self.result[0] += counted
+        if length is not None:
+            remaining = length - counted
+        else:
+            remaining = -1
+
+        while remaining and self._running():
+            if remaining > 0:
+                size = min(remaining, len(self._buffer))
+            else:
+                size = len(self._buffer)
+            if count:
+                granted = size = self._grant(size)
+                if not size:
+                    break
+            received = sock.recv_into(self._buffer, size)
+            if count:
+                self._refund(granted, received)
+            if not received:
+                break
+            if count:
+                self.result[0] += received
+            remaining -= received
+
+        return body[counted:]
+
+    def transfer(self):
+        try:
+            if self._running():
+                urlparts = urlparse(self.request.get_full_url())
+                h = self._build_connection(urlparts[1])
+                try:
+                    if h.sock is None:
+                        h.connect()
+                    self._get(h.sock, self.request)
+                    status, headers, body = self._read_head(h.sock,
+                                                            ''.encode())
+                    if status == 200:
+                        self._drain(h.sock, content_length(headers), body)
+                finally:
+                    h.close()
+        except HTTP_ERRORS + (IOError,):
+            pass
+
+    @property
+    def transferred(self):
+        """Number of bytes received so far"""
+        return self.result[0]
+
+
+class PipelinedHTTPDownloader(RawHTTPDownloader):
+    """Thread class for retrieving several URLs from the same host over a
+    single keep-alive connection, keeping up to ``depth`` GETs in flight so
+    that the connection does not idle between responses
+
+    If the server closes the connection early, the outstanding requests are
+    issued again on a new connection, without pipelining if the server
+    did not manage to complete more than one response per connection
+    """
+
+    def __init__(self, i, requests, start, timeout, build_connection,
+                 depth=4, buffer_size=65536, shutdown_event=None,
+                 budget=None, pacer=None):
+        RawHTTPDownloader.__init__(self, i, requests[0], start, timeout,
+                                   build_connection, buffer_size=buffer_size,
+                                   shutdown_event=shutdown_event,
+                                   budget=budget, pacer=pacer)
+        self.requests = requests
+        self.depth = depth
+
+    def _pipeline(self, requests):
+        """Issue ``requests`` over one connection, returning the number of
+        responses that were completely read
+        """
+
+        completed = 0
+        urlparts = urlparse(requests[0].get_full_url())
+        h = self._build_connection(urlparts[1])
+        try:
+            if h.sock is None:
+                h.connect()
+            sent = 0
+            while sent < min(self.depth, len(requests)):
+                self._get(h.sock, requests[sent], keep_alive=True)
+                sent += 1
+
+            pending = ''.encode()
+            while completed < len(requests) and self._running():
+                status, headers, body = self._read_head(h.sock, pending)
+                length = content_length(headers)
+                pending = self._drain(h.sock, length, body,
+                                      count=status == 200)
+                completed += 1
+                if (length is None or
+                        headers.get('connection', '').lower() == 'close'):
+                    break
+
+                if sent < len(requests):
+                    self._get(h.sock, requests[sent], keep_alive=True)
+                    sent += 1
+        except HTTP_ERRORS + (IOError,):
+            pass
+        finally:
+            h.close()
+
+        return completed
+
+    def transfer(self):
+        remaining = self.requests
+        while remaining and self._running():
+            completed = self._pipeline(remaining)
+            if completed < 2 and self.depth > 1 and len(remaining) > 1:
+                printer('Pipelining unsupported by %s, falling back to one '
+                        'request per connection' %
+                        urlparse(remaining[0].get_full_url())[1], debug=True)
+                self.depth = 1
+            elif not completed:
+                break
+            remaining = remaining[completed:]
+
+
+class HTTPUploaderData(object):
+    """File like object to improve cutting off the upload once the timeout
+    has been reached
+
+    Reads hand out ``chunk_size`` slices of a ``memoryview`` over the shared
+    payload, regardless of the size ``http.client`` asks for, so that each
+    read results in a single large ``sendall`` without copying. Unless
+    ``pre_allocate`` was called, each slice is instead built as it is read
+    """
+
+    def __init__(self, length, start, timeout, shutdown_event=None,
+                 chunk_size=262144, budget=None, pacer=None):
+        self.length = length
+        self.start = start
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.budget = budget
+        self.pacer = pacer
+
+        if shutdown_event:
+            self._shutdown_event = shutdown_event
+        else:
+            self._shutdown_event = FakeShutdownEvent()
+
+        self._data = None
+        self._pos = 0
+
+        self.total = 0
+        self.aborted = False
+
+    def pre_allocate(self, payloads=None):
+        """Build the whole payload ahead of the test, taking it from the
+        ``UploadPayloads`` of the test if given
+        """
+
+        if payloads is None:
+            self._data = memoryview(upload_payload(self.length))
+        else:
+            self._data = memoryview(payloads.get(self.length))
+
+    def read(self, n=10240):
+        if ((timeit.default_timer() - self.start) <= self.timeout and
+                not self._shutdown_event.isSet() and not self.aborted):
+            size = max(n, self.chunk_size)
+            if self._pos < self.length:
+                size = min(size, self.length - self._pos)
+                if self.pacer is not None:
+                    size = min(size, self.pacer.burst)
+                if self.budget is not None:
+                    size = self.budget.take(size)
+                    if not size:
+                        raise SpeedtestUploadTimeout()
+                if self.pacer is not None:
+                    self.pacer.take(size)
+            if self._data is None:
+                chunk = memoryview(upload_payload_slice(self.length,
+                                                        self._pos,
+                                                        self._pos + size))
+            else:
+                chunk = self._data[self._pos:self._pos + size]
+            self._pos += len(chunk)
+            self.total += len(chunk)
+            return chunk
+        else:
+            raise SpeedtestUploadTimeout()
+
+    def __len__(self):
+        return self.length
+
+
+class HTTPUploader(TransferThread):
+    """Thread class for putting a URL"""
+
+    def __init__(self, i, request, start, size, timeout, opener=None,
+                 shutdown_event=None):
+        TransferThread.__init__(self)
+        self.request = request
+        self.request.data.start = self.starttime = start
+        self.size = size
+        self.result = None
+        self.timeout = timeout
+        self.i = i
+
+        if opener:
+            self._opener = opener.open
+        else:
+            self._opener = urlopen
+
+        if shutdown_event:
+            self._shutdown_event = shutdown_event
+        else:
+            self._shutdown_event = FakeShutdownEvent()
+
+    def transfer(self):
         request = self.request
         try:
             if ((timeit.default_timer() - self.starttime) <= self.timeout and
-                    not self._shutdown_event.isSet()):
+                    not self._shutdown_event.isSet() and not self.aborted):
                 try:
                     f = self._opener(request)
                 except TypeError:
                     # PY24 expects a string or buffer
                     # This also causes issues with Ctrl-C, but we will concede
                     # for the moment that Ctrl-C on PY24 isn't immediate
-                    request = build_request(self.request.get_full_url(),
-                                            data=request.data.read(self.size))
+                    request = build_request(
+                        self.request.get_full_url(),
+                        data=request.data.read(self.size).tobytes()
+                    )
                     f = self._opener(request)
                 f.read(11)
                 f.close()
-                self.result = sum(self.request.data.total)
+                self.result = self.request.data.total
             else:
                 self.result = 0
         except (IOError, SpeedtestUploadTimeout):
-            self.result = sum(self.request.data.total)
+            self.result = self.request.data.total
+
+    def abort(self):
+        """Abort the stream, also stopping reads of its request body"""
+
+        self.request.data.aborted = True
+        TransferThread.abort(self)
+
+    @property
+    def transferred(self):
+        """Number of bytes sent so far"""
+        return self.request.data.total
+
+
+def sendfile_supported(url):
+    """Determine whether ``HTTPSendfileUploader`` can be used to upload to
+    ``url``, which requires ``os.sendfile`` and a plain HTTP connection
+    """
+
+    return hasattr(os, 'sendfile') and urlparse(url)[0] == 'http'
+
+
+def build_sendfile_requests(url, sizes, payload, user_agent):
+    """Build the requests for ``HTTPSendfileUploader``, one per size in
+    ``sizes``, returned as ``(request, size)`` tuples
+    """
+
+    requests = []
+    for i, size in enumerate(sizes):
+        headers = {
+            'Content-length': size,
+            'Content-type': 'application/x-www-form-urlencoded',
+            'User-agent': user_agent,
+        }
+        requests.append(
+            (build_request(url, payload, headers=headers, bump=i), size)
+        )
+    return requests
+
+
+class UploadPayloadFile(object):
+    """File descriptor holding ``length`` bytes of upload payload, backed by
+    ``memfd_create`` where available or an unlinked temporary file, for
+    sending request bodies with ``os.sendfile``
+
+    The payload for any smaller size is a prefix of this one, so a single
+    file serves every upload size
+    """
+
+    def __init__(self, length):
+        self.length = int(length)
+        self._file = None
+        try:
+            self._fd = os.memfd_create('speedtest-upload')
+        except (AttributeError, OSError):
+            self._file = tempfile.TemporaryFile()
+            self._fd = self._file.fileno()
+
+        written = 0
+        while written < self.length:
+            chunk = upload_payload_slice(self.length, written,
+                                         written + 1048576)
+            view = memoryview(chunk)
+            while view:
+                view = view[os.write(self._fd, view):]
+            written += len(chunk)
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        else:
+            os.close(self._fd)
+
+
+class HTTPSendfileUploader(TransferThread):
+    """Thread class for posting an upload body straight from an
+    ``UploadPayloadFile`` to the socket with ``os.sendfile``
+
+    Only usable for plain HTTP, the request line and headers are written
+    with ``http.client`` and the body bypasses Python entirely
+    """
+
+    def __init__(self, i, request, start, size, timeout, build_connection,
+                 payload, chunk_size=1048576, shutdown_event=None,
+                 budget=None, pacer=None):
+        TransferThread.__init__(self)
+        self.request = request
+        self.starttime = start
+        self.size = size
+        self.result = None
+        self.timeout = timeout
+        self.i = i
+        self.chunk_size = chunk_size
+        self.total = 0
+        self.budget = budget
+        self.pacer = pacer
+
+        self._build_connection = build_connection
+        self._payload = payload
+
+        if shutdown_event:
+            self._shutdown_event = shutdown_event
+        else:
+            self._shutdown_event = FakeShutdownEvent()
+
+    def _sendfile(self, sock):
+        fileno = sock.fileno()
+        while self.total < self.size:
+            if ((timeit.default_timer() - self.starttime) > self.timeout or
+                    self._shutdown_event.isSet() or self.aborted):
+                raise SpeedtestUploadTimeout()
+            granted = self._grant(min(self.chunk_size,
+                                      self.size - self.total))
+            if not granted:
+                raise SpeedtestUploadTimeout()
+            try:
+                sent = os.sendfile(fileno, self._payload.fileno(), self.total,
+                                   granted)
+            except OSError:
+                self._refund(granted, 0)
+                e = get_exception()
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                # Sockets with a timeout are non-blocking underneath
+                if not select.select([], [fileno], [],
+                                     sock.gettimeout())[1]:
+                    raise socket.timeout('timed out')
+                continue
+            self._refund(granted, sent)
+            if sent == 0:
+                break
+            self.total += sent
+
+    def transfer(self):
+        request = self.request
+        try:
+            if ((timeit.default_timer() - self.starttime) <= self.timeout and
+                    not self._shutdown_event.isSet() and not self.aborted):
+                urlparts = urlparse(request.get_full_url())
+                h = self._build_connection(urlparts[1])
+                try:
+                    h.putrequest('POST', '%s?%s' % (urlparts[2], urlparts[4]),
+                                 skip_accept_encoding=True)
+                    for header, value in request.header_items():
+                        h.putheader(header, value)
+                    h.endheaders()
+                    self._sendfile(h.sock)
+                    f = h.getresponse()
+                    f.read(11)
+                    f.close()
+                finally:
+                    h.close()
+                self.result = self.total
+            else:
+                self.result = 0
+        except HTTP_ERRORS + (IOError, SpeedtestUploadTimeout):
+            self.result = self.total
+
+    @property
+    def transferred(self):
+        """Number of bytes sent so far"""
+        return self.total
+
+
+def pipeline_streams(requests, streams):
+    """Split ``requests`` into at most ``streams`` interleaved lists, one per
+    ``PipelinedHTTPDownloader``
+    """
+
+    streams = max(1, min(streams, len(requests)))
+    return [requests[i::streams] for i in range(streams)]
+
+
+def transfer_process(direction, index, shard, options, barrier, totals,
+                     progress, stops, shutdown):
+    """Target for a ``multiprocessing.Process`` that runs one shard of a
+    download or upload test
+
+    ``shard`` is a list of ``(i, url)`` tuples for downloads, or ``(i, size)``
+    tuples for uploads. Byte counts, started/finished request counts and the
+    stop time are written into the shared ``totals``, ``progress`` and
+    ``stops`` arrays at this worker's ``index``, and no transfers begin until
+    every worker and the parent have reached ``barrier``
+    """
+
+    payload = None
+    try:
+        opener = build_opener(options['source_address'], options['timeout'],
+                              options['resolver'], options['socket_options'],
+                              options['tls_cache'])
+        build_connection = connection_factory(
+            options['url'],
+            options['source_address'],
+            options['timeout'],
+            resolver=options['resolver'],
+            socket_options=options['socket_options'],
+            tls_cache=options['tls_cache']
+        )
+        shutdown_event = ProcessShutdownEvent(shutdown)
+        length = options['length']
+
+        requests = []
+        if direction == 'download':
+            headers = {}
+            if options['raw']:
+                headers['User-agent'] = build_user_agent()
+            for i, url in shard:
+                requests.append(
+                    build_request(url, bump=i, secure=options['secure'],
+                                  headers=headers.copy())
+                )
+            if options['pipeline']:
+                requests = pipeline_streams(requests, options['threads'])
+        elif options['sendfile']:
+            sizes = [size for _, size in shard]
+            payload = UploadPayloadFile(max(sizes))
+            requests = build_sendfile_requests(options['url'], sizes,
+                                               payload, build_user_agent())
+        else:
+            payloads = UploadPayloads()
+            for i, size in shard:
+                data = HTTPUploaderData(size, 0, length,
+                                        shutdown_event=shutdown_event,
+                                        chunk_size=options['chunk_size'],
+                                        budget=options['budget'],
+                                        pacer=options['pacer'])
+                if options['pre_allocate']:
+                    data.pre_allocate(payloads)
+                requests.append(
+                    (
+                        build_request(options['url'], data,
+                                      secure=options['secure'],
+                                      headers={'Content-length': size}),
+                        size
+                    )
+                )
+    except Exception:
+        barrier.abort()
+        raise
+
+    built = {}
+
+    def build_thread(i, request):
+        if direction == 'download' and options['pipeline']:
+            thread = PipelinedHTTPDownloader(i, request, start, length,
+                                             build_connection,
+                                             depth=options['pipeline'],
+                                             shutdown_event=shutdown_event,
+                                             budget=options['budget'],
+                                             pacer=options['pacer'])
+        elif direction == 'download' and options['raw']:
+            thread = RawHTTPDownloader(i, request, start, length,
+                                       build_connection,
+                                       shutdown_event=shutdown_event,
+                                       budget=options['budget'],
+                                       pacer=options['pacer'])
+        elif direction == 'download':
+            thread = HTTPDownloader(i, request, start, length, opener=opener,
+                                    shutdown_event=shutdown_event,
+                                    budget=options['budget'],
+                                    pacer=options['pacer'])
+        elif payload is not None:
+            thread = HTTPSendfileUploader(i, request[0], start, request[1],
+                                          length, build_connection, payload,
+                                          shutdown_event=shutdown_event,
+                                          budget=options['budget'],
+                                          pacer=options['pacer'])
+        else:
+            thread = HTTPUploader(i, request[0], start, request[1], length,
+                                  opener=opener,
+                                  shutdown_event=shutdown_event)
+        built[i] = thread
+        return thread
+
+    def callback(i, request_count, start=False, end=False):
+        if start:
+            progress[index * 2] += 1
+        if end:
+            thread = built.pop(i)
+            if direction == 'download':
+                totals[index] += sum(thread.result)
+            else:
+                totals[index] += thread.result or 0
+            progress[index * 2 + 1] += 1
+
+    try:
+        try:
+            barrier.wait(WORKER_START_TIMEOUT)
+        except threading.BrokenBarrierError:
+            return
+
+        start = timeit.default_timer()
+        run_transfers(requests, build_thread, options['threads'], callback)
+        stops[index] = timeit.default_timer()
+    finally:
+        if payload is not None:
+            payload.close()
+
+
+class LatencyProber(object):
+    """Class for measuring server latency in background threads, so that
+    probing candidate servers can overlap with retrieving the server list,
+    and candidates are probed concurrently instead of one after another
+
+    ``measure(server)`` returns the latency of ``server``. Results are kept
+    per server URL
+    """
+
+    def __init__(self, measure):
+        self._measure = measure
+        self._threads = {}
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def probe(self, server):
+        """Start measuring ``server`` unless it is already being measured"""
+
+        self._lock.acquire()
+        try:
+            if server['url'] in self._threads:
+                return
+            thread = threading.Thread(target=self._run, args=(server,))
+            thread.daemon = True
+            self._threads[server['url']] = thread
+        finally:
+            self._lock.release()
+        thread.start()
+
+    def _run(self, server):
+        self._results[server['url']] = self._measure(server)
+
+    def latency(self, server):
+        """Return the latency of ``server``, waiting for a probe started
+        earlier to finish
+        """
+
+        self.probe(server)
+        thread = self._threads[server['url']]
+        while is_alive(thread):
+            thread.join(timeout=0.1)
+        try:
+            return self._results[server['url']]
+        except KeyError:
+            return self._measure(server)
+
+
+class KeepAliveProbe(object):
+    """Class for measuring the round trip to a server with requests for
+    ``latency.txt`` over a single keep-alive connection, cheap enough to
+    run every few seconds between full tests
+
+    The connection is opened on the first probe, and again on the probe
+    after any failure
+    """
+
+    def __init__(self, url, build_connection, user_agent=None):
+        urlparts = urlparse('%s/latency.txt' % os.path.dirname(url))
+        self.host = urlparts[1]
+        self.path = urlparts[2]
+        self._build_connection = build_connection
+        self._headers = {
+            'User-Agent': user_agent or build_user_agent(),
+            'Connection': 'keep-alive',
+        }
+        self._connection = None
+        self._stamp = int(timeit.time.time() * 1000)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def probe(self):
+        """Return the round trip of one request in milliseconds, excluding
+        any connection setup, or ``None`` if the server could not be reached
+        """
+
+        self._lock.acquire()
+        try:
+            self._count += 1
+            path = '%s?x=%s.%s' % (self.path, self._stamp, self._count)
+            try:
+                if self._connection is None:
+                    self._connection = self._build_connection(self.host)
+                    self._connection.connect()
+                h = self._connection
+                start = timeit.default_timer()
+                h.request('GET', path, headers=self._headers)
+                r = h.getresponse()
+                total = timeit.default_timer() - start
+                text = r.read()
+            except HTTP_ERRORS:
+                e = get_exception()
+                printer('Probe of %s failed: %r' % (self.host, e), debug=True)
+                self._close()
+                return None
+
+            if (int(r.status) != 200 or
+                    not text.startswith('test=test'.encode())):
+                self._close()
+                return None
+            if r.will_close:
+                self._close()
+            return round(total * 1000.0, 3)
+        finally:
+            self._lock.release()
+
+    def _close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def close(self):
+        """Close the keep-alive connection"""
+
+        self._lock.acquire()
+        try:
+            self._close()
+        finally:
+            self._lock.release()
 
 
 class SpeedtestResults(object):
@@ -909,6 +2776,14 @@ class SpeedtestResults(object):
         self.timestamp = '%sZ' % datetime.datetime.utcnow().isoformat()
         self.bytes_received = 0
         self.bytes_sent = 0
+        self.socket_options = {}
+        self.tls = {}
+        self.family = None
+        self.duplex = {}
+        self.streams = {}
+        self.stalls = {}
+        self.budget = {}
+        self.pacing = {}
 
         if opener:
             self._opener = opener
@@ -994,6 +2869,14 @@ class SpeedtestResults(object):
             'bytes_received': self.bytes_received,
             'share': self._share,
             'client': self.client,
+            'socket_options': self.socket_options,
+            'tls': self.tls,
+            'family': self.family,
+            'duplex': self.duplex,
+            'streams': self.streams,
+            'stalls': self.stalls,
+            'budget': self.budget,
+            'pacing': self.pacing,
         }
 
     @staticmethod
@@ -1032,16 +2915,125 @@ class SpeedtestResults(object):
         return json.dumps(self.dict(), **kwargs)
 
 
+class SpeedtestDualStackResults(object):
+    """Class for holding the results of testing the same server over IPv4
+    and IPv6, including:
+
+    A ``SpeedtestResults`` for each address family that could be tested
+    The error for each address family that could not
+    The IPv6 to IPv4 ratio of download, upload and ping
+
+    Like ``SpeedtestResults`` this class can return the result data as a
+    dictionary, JSON or CSV
+    """
+
+    def __init__(self, ipv4=None, ipv6=None, errors=None):
+        self.ipv4 = ipv4
+        self.ipv6 = ipv6
+        self.errors = errors or {}
+
+    def __repr__(self):
+        return repr(self.dict())
+
+    def ratio(self):
+        """Return the IPv6 to IPv4 ratio of download, upload and ping,
+        ``None`` for any value missing from either family
+        """
+
+        ratio = {}
+        for key in ('download', 'upload', 'ping'):
+            try:
+                ratio[key] = (getattr(self.ipv6, key) /
+                              float(getattr(self.ipv4, key)))
+            except (AttributeError, ZeroDivisionError):
+                ratio[key] = None
+        return ratio
+
+    def dict(self):
+        """Return dictionary of result data"""
+
+        data = {'ratio': self.ratio(), 'errors': self.errors}
+        for name in ('ipv4', 'ipv6'):
+            results = getattr(self, name)
+            data[name] = results and results.dict()
+        return data
+
+    @staticmethod
+    def csv_header(delimiter=','):
+        """Return CSV Headers"""
+
+        return '%s%s%s' % ('Family', delimiter,
+                           SpeedtestResults.csv_header(delimiter=delimiter))
+
+    def csv(self, delimiter=','):
+        """Return data in CSV format, one row per tested address family"""
+
+        rows = []
+        for name, label in (('ipv4', 'IPv4'), ('ipv6', 'IPv6')):
+            results = getattr(self, name)
+            if results:
+                rows.append('%s%s%s' % (label, delimiter,
+                                        results.csv(delimiter=delimiter)))
+        return '\n'.join(rows)
+
+    def json(self, pretty=False):
+        """Return data in JSON format"""
+
+        kwargs = {}
+        if pretty:
+            kwargs.update({
+                'indent': 4,
+                'sort_keys': True
+            })
+        return json.dumps(self.dict(), **kwargs)
+
+
 class Speedtest(object):
     """Class for performing standard speedtest.net testing operations"""
 
     def __init__(self, config=None, source_address=None, timeout=10,
-                 secure=False, shutdown_event=None):
+                 secure=False, shutdown_event=None, dns_ttl=300,
+                 socket_options=None, prewarm=True, budget=None, pace=None,
+                 pace_probe=None):
         self.config = {}
 
         self._source_address = source_address
         self._timeout = timeout
-        self._opener = build_opener(source_address, timeout)
+        self._resolver = DNSCache(dns_ttl)
+
+        self._socket_options = SocketOptions(**(socket_options or {}))
+        if self._socket_options:
+            self._socket_options.validate()
+
+        if ssl:
+            self._tls_cache = TLSSessionCache()
+        else:
+            self._tls_cache = None
+
+        self._pool = ConnectionPool()
+        self._prewarm = prewarm
+
+        # Bytes of response and request body the session may transfer
+        self.budget = budget
+        self.budget_used = 0
+        # Bytes granted to tests that are still running, and grants fixed
+        # ahead of tests that run at the same time
+        self._budget_reserved = 0
+        self._budget_split = {}
+        self._budget_lock = threading.Lock()
+
+        # Combined rate in bits per second every stream is paced to, after
+        # an unpaced probe of ``pace_probe`` seconds at the start of a test
+        self.pace = pace
+        self.pace_probe = pace_probe
+        if pace:
+            self._pacer = TokenBucket(pace)
+        else:
+            self._pacer = None
+
+        self._opener = build_opener(source_address, timeout, self._resolver,
+                                    self._socket_options, self._tls_cache,
+                                    self._pool)
 
         self._secure = secure
 
@@ -1057,12 +3049,29 @@ class Speedtest(object):
         self.servers = {}
         self.closest = []
         self._best = {}
+        self._prober = None
+        self._transfers = {'download': [], 'upload': []}
 
         self.results = SpeedtestResults(
             client=self.config['client'],
             opener=self._opener,
             secure=secure,
         )
+        if self._socket_options:
+            self.results.socket_options = self._socket_options.dict()
+
+    @property
+    def budget_spent(self):
+        """Bytes of the session budget used by finished tests, plus those
+        granted to tests that did not finish, which is the most the session
+        may have transferred
+        """
+
+        self._budget_lock.acquire()
+        try:
+            return self.budget_used + self._budget_reserved
+        finally:
+            self._budget_lock.release()
 
     @property
     def best(self):
@@ -1138,11 +3147,9 @@ class Speedtest(object):
 
         ratio = int(upload['ratio'])
         upload_max = int(upload['maxchunkcount'])
-        up_sizes = [32768, 65536, 131072, 262144, 524288, 1048576, 7340032]
         sizes = {
-            'upload': up_sizes[ratio - 1:],
-            'download': [350, 500, 750, 1000, 1500, 2000, 2500,
-                         3000, 3500, 4000]
+            'upload': UPLOAD_SIZES[ratio - 1:],
+            'download': DOWNLOAD_SIZES[:]
         }
 
         size_count = len(sizes['upload'])
@@ -1186,9 +3193,13 @@ class Speedtest(object):
 
         return self.config
 
-    def get_servers(self, servers=None, exclude=None):
+    def get_servers(self, servers=None, exclude=None, probe=False):
         """Retrieve a the list of speedtest.net servers, optionally filtered
         to servers matching those specified in the ``servers`` argument
+
+        With ``probe``, servers that are among the closest seen so far are
+        latency tested while the list is still streaming in, and those
+        results are used by ``get_best_server``
         """
         if servers is None:
             servers = []
@@ -1218,99 +3229,216 @@ class Speedtest(object):
         if gzip:
             headers['Accept-Encoding'] = 'gzip'
 
-        errors = []
-        for url in urls:
+        found = None
+        if probe:
+            found = self._probe_candidates(servers, exclude)
+
+        for attrib in self._race_servers(urls, headers, found):
+            d = self._server_distance(attrib, servers, exclude)
+            if d is None:
+                continue
+
+            attrib['d'] = d
+
             try:
-                request = build_request(
-                    '%s?threads=%s' % (url,
-                                       self.config['threads']['download']),
-                    headers=headers,
-                    secure=self._secure
-                )
-                uh, e = catch_request(request, opener=self._opener)
-                if e:
-                    errors.append('%s' % e)
-                    raise ServersRetrievalError()
+                self.servers[d].append(attrib)
+            except KeyError:
+                self.servers[d] = [attrib]
+
+        if (servers or exclude) and not self.servers:
+            raise NoMatchedServers()
+
+        return self.servers
+
+    def _server_distance(self, attrib, servers, exclude):
+        """Return the distance to the server described by ``attrib``, or
+        ``None`` if it is filtered out by ``servers``, ``exclude`` or the
+        configured ignore list
+        """
+
+        if servers and int(attrib.get('id')) not in servers:
+            return None
+
+        if (int(attrib.get('id')) in self.config['ignore_servers']
+                or int(attrib.get('id')) in exclude):
+            return None
+
+        try:
+            return distance(self.lat_lon,
+                            (float(attrib.get('lat')),
+                             float(attrib.get('lon'))))
+        except Exception:
+            return None
+
+    def _probe_candidates(self, servers, exclude, limit=5):
+        """Return a callback for ``_race_servers`` that starts a latency
+        probe for each streamed server that is among the ``limit`` closest
+        seen so far
+
+        Server lists are normally sorted nearest first, so this usually
+        probes exactly the servers ``get_closest_servers`` will pick. At
+        most ``limit * 2`` servers are probed early
+        """
+
+        user_agent = build_user_agent()
+        self._prober = LatencyProber(
+            lambda server: self.server_latency(server, user_agent)
+        )
+        nearest = []
+        probed = []
+        lock = threading.Lock()
+
+        def found(attrib):
+            d = self._server_distance(attrib, servers, exclude)
+            if d is None:
+                return
+            lock.acquire()
+            try:
+                if len(probed) >= limit * 2 or attrib['url'] in probed:
+                    return
+                nearest.append(d)
+                nearest.sort()
+                if nearest.index(d) >= limit:
+                    return
+                probed.append(attrib['url'])
+            finally:
+                lock.release()
+            printer('Probing %(url)s early' % attrib, debug=True)
+            self._prober.probe(attrib)
+
+        return found
+
+    def _race_servers(self, urls, headers, found=None):
+        """Fetch the server list from all of ``urls`` concurrently, and
+        return the server attributes from the first mirror to respond with
+        a fully parsed list. The remaining fetches are cancelled
+
+        ``found``, if given, is called with the attributes of each server as
+        it is parsed from any mirror, before the list is complete
+
+        Returns an empty list if no mirror succeeds
+        """
 
-                stream = get_response_stream(uh)
+        cancel = threading.Event()
+        responses = Queue()
 
-                serversxml_list = []
+        def fetch(url):
+            try:
+                parsed = self._fetch_servers(url, headers, cancel, found)
+            except Exception:
+                responses.put((url, None, get_exception()))
+            else:
+                responses.put((url, parsed, None))
+
+        for url in urls:
+            thread = threading.Thread(target=fetch, args=(url,))
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for _ in urls:
                 while 1:
                     try:
-                        serversxml_list.append(stream.read(1024))
-                    except (OSError, EOFError):
-                        raise ServersRetrievalError(get_exception())
-                    if len(serversxml_list[-1]) == 0:
+                        url, parsed, e = responses.get(True, 0.1)
                         break
+                    except Empty:
+                        if self._shutdown_event.isSet():
+                            return []
+                if parsed is not None:
+                    printer('Server list from %s' % url, debug=True)
+                    return parsed
+                printer('Server list from %s failed: %r' % (url, e),
+                        debug=True)
+        finally:
+            cancel.set()
 
-                stream.close()
-                uh.close()
+        return []
 
-                if int(uh.code) != 200:
-                    raise ServersRetrievalError()
+    def _fetch_servers(self, url, headers, cancel, found=None):
+        """Retrieve and parse a single server list mirror, returning a list
+        of server attribute dictionaries
 
-                serversxml = ''.encode().join(serversxml_list)
+        ``found`` is called with each server as it streams in, where
+        ``ET.XMLPullParser`` is available
 
-                printer('Servers XML:\n%s' % serversxml, debug=True)
+        Raises ``ServersRetrievalError`` on failure, or once ``cancel`` is
+        set
+        """
 
-                try:
-                    try:
-                        try:
-                            root = ET.fromstring(serversxml)
-                        except ET.ParseError:
-                            e = get_exception()
-                            raise SpeedtestServersError(
-                                'Malformed speedtest.net server list: %s' % e
-                            )
-                        elements = root.getiterator('server')
-                    except AttributeError:
-                        try:
-                            root = DOM.parseString(serversxml)
-                        except ExpatError:
-                            e = get_exception()
-                            raise SpeedtestServersError(
-                                'Malformed speedtest.net server list: %s' % e
-                            )
-                        elements = root.getElementsByTagName('server')
-                except (SyntaxError, xml.parsers.expat.ExpatError):
-                    raise ServersRetrievalError()
-
-                for server in elements:
-                    try:
-                        attrib = server.attrib
-                    except AttributeError:
-                        attrib = dict(list(server.attributes.items()))
+        request = build_request(
+            '%s?threads=%s' % (url, self.config['threads']['download']),
+            headers=headers,
+            secure=self._secure
+        )
+        uh, e = catch_request(request, opener=self._opener)
+        if e:
+            raise ServersRetrievalError(e)
 
-                    if servers and int(attrib.get('id')) not in servers:
-                        continue
+        stream = get_response_stream(uh)
 
-                    if (int(attrib.get('id')) in self.config['ignore_servers']
-                            or int(attrib.get('id')) in exclude):
-                        continue
+        pull = None
+        if found and hasattr(ET, 'XMLPullParser'):
+            pull = ET.XMLPullParser()
 
-                    try:
-                        d = distance(self.lat_lon,
-                                     (float(attrib.get('lat')),
-                                      float(attrib.get('lon'))))
-                    except Exception:
-                        continue
+        serversxml_list = []
+        while 1:
+            if cancel.isSet():
+                uh.close()
+                raise ServersRetrievalError('Cancelled')
+            try:
+                serversxml_list.append(stream.read(1024))
+            except (OSError, EOFError):
+                raise ServersRetrievalError(get_exception())
+            if len(serversxml_list[-1]) == 0:
+                break
+            if pull is not None:
+                try:
+                    pull.feed(serversxml_list[-1])
+                    for _, element in pull.read_events():
+                        if element.tag == 'server':
+                            found(dict(element.attrib))
+                except ET.ParseError:
+                    pull = None
 
-                    attrib['d'] = d
+        stream.close()
+        uh.close()
 
-                    try:
-                        self.servers[d].append(attrib)
-                    except KeyError:
-                        self.servers[d] = [attrib]
+        if int(uh.code) != 200:
+            raise ServersRetrievalError()
 
-                break
+        serversxml = ''.encode().join(serversxml_list)
 
-            except ServersRetrievalError:
-                continue
+        printer('Servers XML:\n%s' % serversxml, debug=True)
 
-        if (servers or exclude) and not self.servers:
-            raise NoMatchedServers()
+        try:
+            try:
+                try:
+                    root = ET.fromstring(serversxml)
+                except ET.ParseError:
+                    e = get_exception()
+                    raise SpeedtestServersError(
+                        'Malformed speedtest.net server list: %s' % e
+                    )
+                elements = etree_iter(root, 'server')
+            except AttributeError:
+                try:
+                    root = DOM.parseString(serversxml)
+                except ExpatError:
+                    e = get_exception()
+                    raise SpeedtestServersError(
+                        'Malformed speedtest.net server list: %s' % e
+                    )
+                elements = root.getElementsByTagName('server')
+        except (SyntaxError, xml.parsers.expat.ExpatError):
+            raise ServersRetrievalError()
 
-        return self.servers
+        parsed = []
+        for server in elements:
+            try:
+                parsed.append(server.attrib)
+            except AttributeError:
+                parsed.append(dict(list(server.attributes.items())))
+        return parsed
 
     def set_mini_server(self, server):
         """Instead of querying for a list of servers, set a link to a
@@ -1396,55 +3524,20 @@ class Speedtest(object):
                 servers = self.get_closest_servers()
             servers = self.closest
 
-        if self._source_address:
-            source_address_tuple = (self._source_address, 0)
-        else:
-            source_address_tuple = None
-
         user_agent = build_user_agent()
 
-        results = {}
+        prober = self._prober
+        self._prober = None
+        if prober is None:
+            prober = LatencyProber(
+                lambda server: self.server_latency(server, user_agent)
+            )
         for server in servers:
-            cum = []
-            url = os.path.dirname(server['url'])
-            stamp = int(timeit.time.time() * 1000)
-            latency_url = '%s/latency.txt?x=%s' % (url, stamp)
-            for i in range(0, 3):
-                this_latency_url = '%s.%s' % (latency_url, i)
-                printer('%s %s' % ('GET', this_latency_url),
-                        debug=True)
-                urlparts = urlparse(latency_url)
-                try:
-                    if urlparts[0] == 'https':
-                        h = SpeedtestHTTPSConnection(
-                            urlparts[1],
-                            source_address=source_address_tuple
-                        )
-                    else:
-                        h = SpeedtestHTTPConnection(
-                            urlparts[1],
-                            source_address=source_address_tuple
-                        )
-                    headers = {'User-Agent': user_agent}
-                    path = '%s?%s' % (urlparts[2], urlparts[4])
-                    start = timeit.default_timer()
-                    h.request("GET", path, headers=headers)
-                    r = h.getresponse()
-                    total = (timeit.default_timer() - start)
-                except HTTP_ERRORS:
-                    e = get_exception()
-                    printer('ERROR: %r' % e, debug=True)
-                    cum.append(3600)
-                    continue
-
-                text = r.read(9)
-                if int(r.status) == 200 and text == 'test=test'.encode():
-                    cum.append(total)
-                else:
-                    cum.append(3600)
-                h.close()
+            prober.probe(server)
 
-            avg = round((sum(cum) / 6) * 1000.0, 3)
+        results = {}
+        for server in servers:
+            avg = prober.latency(server)
             results[avg] = server
 
         try:
@@ -1460,81 +3553,464 @@ class Speedtest(object):
 
         self._best.update(best)
         printer('Best Server:\n%r' % best, debug=True)
+
+        self._resolve_best()
+        self._record_connections()
+        if self._prewarm:
+            self._warm_best()
+
         return best
 
-    def download(self, callback=do_nothing, threads=None):
+    def server_latency(self, server, user_agent=None):
+        """Perform a speedtest.net "ping" of ``server`` and return the
+        latency in milliseconds
+        """
+
+        if user_agent is None:
+            user_agent = build_user_agent()
+
+        build_connection = connection_factory(
+            server['url'],
+            self._source_address,
+            self._timeout,
+            resolver=self._resolver,
+            socket_options=self._socket_options,
+            tls_cache=self._tls_cache
+        )
+
+        cum = []
+        url = os.path.dirname(server['url'])
+        stamp = int(timeit.time.time() * 1000)
+        latency_url = '%s/latency.txt?x=%s' % (url, stamp)
+        for i in range(0, 3):
+            this_latency_url = '%s.%s' % (latency_url, i)
+            printer('%s %s' % ('GET', this_latency_url),
+                    debug=True)
+            urlparts = urlparse(latency_url)
+            try:
+                h = build_connection(urlparts[1])
+                headers = {'User-Agent': user_agent}
+                path = '%s?%s' % (urlparts[2], urlparts[4])
+                start = timeit.default_timer()
+                h.request("GET", path, headers=headers)
+                r = h.getresponse()
+                total = (timeit.default_timer() - start)
+            except HTTP_ERRORS:
+                e = get_exception()
+                printer('ERROR: %r' % e, debug=True)
+                cum.append(3600)
+                continue
+
+            text = r.read(9)
+            if int(r.status) == 200 and text == 'test=test'.encode():
+                cum.append(total)
+            else:
+                cum.append(3600)
+            h.close()
+
+        return round((sum(cum) / 6) * 1000.0, 3)
+
+    def keep_alive_probe(self):
+        """Return a ``KeepAliveProbe`` of the best server, reusing the session
+        DNS cache, socket options and TLS sessions
+        """
+
+        return KeepAliveProbe(
+            self.best['url'],
+            connection_factory(
+                self.best['url'],
+                self._source_address,
+                self._timeout,
+                resolver=self._resolver,
+                socket_options=self._socket_options,
+                tls_cache=self._tls_cache
+            )
+        )
+
+    def _resolve_best(self, min_ttl=0):
+        """Resolve the best server host through the session ``DNSCache``,
+        so that connections made to it during a test skip name resolution
+        """
+
+        urlparts = urlparse(self.best['url'])
+        port = urlparts.port or (80, 443)[urlparts.scheme == 'https']
+        self._resolver.resolve(urlparts.hostname, port, min_ttl=min_ttl)
+
+    def _warm_best(self):
+        """Start opening one connection per download thread to the best
+        server in the background, each warmed with a keep-alive request for
+        ``latency.txt``, for the download engine to take from the pool
+        """
+
+        self._pool.clear()
+        urlparts = urlparse(self.best['url'])
+        build_connection = connection_factory(
+            self.best['url'],
+            self._source_address,
+            self._timeout,
+            resolver=self._resolver,
+            socket_options=self._socket_options,
+            tls_cache=self._tls_cache
+        )
+        self._pool.warm(build_connection, urlparts[1],
+                        '%s/latency.txt' % os.path.dirname(urlparts[2]),
+                        self.config['threads']['download'],
+                        headers={'User-Agent': build_user_agent()})
+
+    def _run_processes(self, direction, items, processes, threads, callback,
+                       options):
+        """Shard ``items`` across ``processes`` worker processes running
+        ``transfer_process``, and return the aggregate number of bytes
+        transferred and the elapsed time
+
+        Workers are released together from a common barrier, and the elapsed
+        time runs from that barrier to the last worker finishing
+        """
+
+        if multiprocessing is None:
+            raise SpeedtestException('This version of Python does not '
+                                     'support the multi-process engine')
+
+        processes = max(1, min(processes, len(items)))
+        request_count = len(items)
+        indexed = list(enumerate(items))
+
+        options.update({
+            'source_address': self._source_address,
+            'timeout': self._timeout,
+            'resolver': self._resolver,
+            'socket_options': self._socket_options,
+            'tls_cache': self._tls_cache,
+            'secure': self._secure,
+            'threads': max(1, int(math.ceil(threads / float(processes)))),
+        })
+
+        barrier = multiprocessing.Barrier(processes + 1)
+        totals = multiprocessing.Array('d', processes, lock=False)
+        stops = multiprocessing.Array('d', processes, lock=False)
+        progress = multiprocessing.Array('i', processes * 2, lock=False)
+        shutdown = multiprocessing.Event()
+
+        workers = []
+        for index in range(processes):
+            worker = multiprocessing.Process(
+                target=transfer_process,
+                args=(direction, index, indexed[index::processes], options,
+                      barrier, totals, progress, stops, shutdown)
+            )
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        printer('Started %d %s processes' % (processes, direction),
+                debug=True)
+
+        try:
+            # A worker that dies before reaching the barrier never aborts it
+            while barrier.n_waiting < processes:
+                if (barrier.broken or self._shutdown_event.isSet() or
+                        [worker for worker in workers
+                         if not is_alive(worker)]):
+                    barrier.abort()
+                    raise threading.BrokenBarrierError()
+                time.sleep(0.05)
+            barrier.wait(WORKER_START_TIMEOUT)
+        except threading.BrokenBarrierError:
+            shutdown.set()
+            for worker in workers:
+                worker.join()
+            raise SpeedtestException('Unable to start %s worker processes' %
+                                     direction)
+
+        start = timeit.default_timer()
+        started = 0
+        ended = 0
+        while 1:
+            if self._shutdown_event.isSet():
+                shutdown.set()
+
+            while started < sum(progress[0::2]):
+                callback(started, request_count, start=True)
+                started += 1
+            while ended < sum(progress[1::2]):
+                callback(ended, request_count, end=True)
+                ended += 1
+
+            alive = [worker for worker in workers if is_alive(worker)]
+            if not alive:
+                break
+            alive[0].join(timeout=0.1)
+
+        stop = max(stops) or timeit.default_timer()
+        return sum(totals), stop - start
+
+    def auto_size(self, length=1.0):
+        """Estimate the bandwidth to the best server with a probe of
+        ``length`` seconds in each direction, and replace the size ladders
+        and per size counts in ``self.config`` with ones that keep every
+        stream busy for the test length, see ``size_ladder``
+
+        With a session pace, the pace is used as the estimate instead.
+        Returns a dictionary of the estimated ``download`` and ``upload``
+        rates in bits per second
+        """
+
+        estimate = {}
+        used = 0
+        for direction in ('download', 'upload'):
+            if self.pace:
+                estimate[direction] = self.pace
+                continue
+
+            threads = self.config['threads'][direction]
+            budget = None
+            if self.budget is not None:
+                budget = ByteBudget(
+                    max(0, self.budget - self.budget_used -
+                        self._budget_reserved - used) // 10
+                )
+
+            requests = []
+            for i in range(threads * 4):
+                if direction == 'download':
+                    requests.append(build_request(
+                        '%s/random1500x1500.jpg' %
+                        os.path.dirname(self.best['url']),
+                        bump=i, secure=self._secure
+                    ))
+                else:
+                    data = HTTPUploaderData(
+                        1048576, 0, length,
+                        shutdown_event=self._shutdown_event, budget=budget
+                    )
+                    requests.append(build_request(
+                        self.best['url'], data, secure=self._secure,
+                        headers={'Content-length': 1048576}
+                    ))
+
+            def build_thread(i, request):
+                if direction == 'download':
+                    return HTTPDownloader(i, request, start, length,
+                                          opener=self._opener,
+                                          shutdown_event=self._shutdown_event,
+                                          budget=budget)
+                return HTTPUploader(i, request, start, 1048576, length,
+                                    opener=self._opener,
+                                    shutdown_event=self._shutdown_event)
+
+            started = []
+            start = timeit.default_timer()
+            run_transfers(requests, build_thread, threads, started=started)
+            elapsed = timeit.default_timer() - start
+            transferred = sum([thread.transferred for thread in started])
+            used += transferred
+            estimate[direction] = transferred * 8.0 / elapsed
+
+        if self.budget is not None:
+            self.budget_used += used
+
+        sizes, count = size_ladder(estimate['download'],
+                                   self.config['length']['download'],
+                                   self.config['threads']['download'],
+                                   DOWNLOAD_SIZES, download_size_bytes)
+        self.config['sizes']['download'] = sizes
+        self.config['counts']['download'] = count
+
+        sizes, count = size_ladder(estimate['upload'],
+                                   self.config['length']['upload'],
+                                   self.config['threads']['upload'],
+                                   UPLOAD_SIZES)
+        self.config['sizes']['upload'] = sizes
+        self.config['counts']['upload'] = count
+        self.config['upload_max'] = count * len(sizes)
+
+        printer('Size ladders from estimate %r:\n%r\n%r' %
+                (estimate, self.config['sizes'], self.config['counts']),
+                debug=True)
+
+        # The probe used up any warm connections
+        if self._prewarm:
+            self._warm_best()
+
+        return estimate
+
+    def download(self, callback=do_nothing, threads=None, processes=None,
+                 raw=False, pipeline=None, stall_timeout=None,
+                 failover=False):
         """Test download speed against speedtest.net
 
         A ``threads`` value of ``None`` will fall back to those dictated
         by the speedtest.net configuration
+
+        A ``processes`` value greater than ``1`` shards the requests across
+        that many worker processes, with ``threads`` divided between them
+
+        A ``raw`` value of ``True`` uses ``RawHTTPDownloader`` threads, which
+        bypass ``urllib``/``http.client`` and do not support proxies
+
+        A ``pipeline`` value greater than ``1`` implies ``raw``, and spreads
+        the requests over ``threads`` keep-alive connections, each keeping
+        that many requests in flight
+
+        A ``stall_timeout`` in seconds aborts streams that make no progress
+        for that long and replaces them with fresh streams, to the next
+        closest servers in turn if ``failover`` is ``True``. Stalls are
+        recorded in ``self.results.stalls``. Not supported with
+        ``processes``
         """
 
+        if stall_timeout and processes and processes > 1:
+            raise SpeedtestException('stall_timeout is not supported with '
+                                     'processes')
+
         urls = []
         for size in self.config['sizes']['download']:
             for _ in range(0, self.config['counts']['download']):
                 urls.append('%s/random%sx%s.jpg' %
                             (os.path.dirname(self.best['url']), size, size))
 
-        request_count = len(urls)
-        requests = []
-        for i, url in enumerate(urls):
-            requests.append(
-                build_request(url, bump=i, secure=self._secure)
+        threads = threads or self.config['threads']['download']
+
+        if pipeline and pipeline > 1:
+            raw = True
+        else:
+            pipeline = None
+
+        # Make sure the cached address outlives the test
+        self._resolve_best(self.config['length']['download'] + self._timeout)
+
+        multiprocess = processes and processes > 1
+        budget = self._take_budget('download', multiprocess)
+        pacer = self._take_pacer(multiprocess)
+
+        if multiprocess:
+            # Streams run in the worker processes, and are not tracked
+            self._transfers['download'] = []
+            bytes_received, elapsed = self._run_processes(
+                'download', urls, processes, threads, callback,
+                {
+                    'length': self.config['length']['download'],
+                    'url': self.best['url'],
+                    'raw': raw,
+                    'pipeline': pipeline,
+                    'budget': budget,
+                    'pacer': pacer,
+                }
             )
+        else:
+            headers = {}
+            if raw:
+                build_connection = self._connection_factory()
+                headers['User-agent'] = build_user_agent()
+
+            requests = []
+            for i, url in enumerate(urls):
+                requests.append(
+                    build_request(url, bump=i, secure=self._secure,
+                                  headers=headers.copy())
+                )
 
-        def producer(q, requests, request_count):
-            for i, request in enumerate(requests):
-                thread = HTTPDownloader(
+            if pipeline:
+                requests = pipeline_streams(requests, threads)
+
+            # Start the clock only once warm connections are ready
+            self._pool.wait()
+
+            def build_thread(i, request):
+                if pipeline:
+                    return PipelinedHTTPDownloader(
+                        i,
+                        request,
+                        start,
+                        self.config['length']['download'],
+                        build_connection,
+                        depth=pipeline,
+                        shutdown_event=self._shutdown_event,
+                        budget=budget,
+                        pacer=pacer
+                    )
+                if raw:
+                    return RawHTTPDownloader(
+                        i,
+                        request,
+                        start,
+                        self.config['length']['download'],
+                        build_connection,
+                        shutdown_event=self._shutdown_event,
+                        budget=budget,
+                        pacer=pacer
+                    )
+                return HTTPDownloader(
                     i,
                     request,
                     start,
                     self.config['length']['download'],
                     opener=self._opener,
-                    shutdown_event=self._shutdown_event
+                    shutdown_event=self._shutdown_event,
+                    budget=budget,
+                    pacer=pacer
                 )
-                thread.start()
-                q.put(thread, True)
-                callback(i, request_count, start=True)
-
-        finished = []
 
-        def consumer(q, request_count):
-            while len(finished) < request_count:
-                thread = q.get(True)
-                while thread.isAlive():
-                    thread.join(timeout=0.1)
-                finished.append(sum(thread.result))
-                callback(thread.i, request_count, end=True)
-
-        q = Queue(threads or self.config['threads']['download'])
-        prod_thread = threading.Thread(target=producer,
-                                       args=(q, requests, request_count))
-        cons_thread = threading.Thread(target=consumer,
-                                       args=(q, request_count))
-        start = timeit.default_timer()
-        prod_thread.start()
-        cons_thread.start()
-        while prod_thread.isAlive():
-            prod_thread.join(timeout=0.1)
-        while cons_thread.isAlive():
-            cons_thread.join(timeout=0.1)
-
-        stop = timeit.default_timer()
-        self.results.bytes_received = sum(finished)
+            def replace(thread, server):
+                request = requests[thread.i]
+                if server is not None:
+                    if pipeline:
+                        request = [retarget_request(r, self.best['url'],
+                                                    server['url'])
+                                   for r in request]
+                    else:
+                        request = retarget_request(request, self.best['url'],
+                                                   server['url'])
+                return build_thread(thread.i, request)
+
+            started = self._transfers_started('download')
+            start = timeit.default_timer()
+            watchdog = self._watch('download', replace, stall_timeout,
+                                   failover)
+            run_transfers(requests, build_thread, threads, callback, started)
+            self._unwatch('download', watchdog)
+            elapsed = timeit.default_timer() - start
+            bytes_received = sum([thread.transferred for thread in started])
+
+        self.results.bytes_received = int(bytes_received)
         self.results.download = (
-            (self.results.bytes_received / (stop - start)) * 8.0
+            (self.results.bytes_received / elapsed) * 8.0
         )
         if self.results.download > 100000:
             self.config['threads']['upload'] = 8
+        self._spend_budget(budget)
+        self._spend_pacer('download', pacer)
+        self.results.streams['download'] = stream_stats(
+            self._transfers['download']
+        )
+        self._record_connections()
         return self.results.download
 
-    def upload(self, callback=do_nothing, pre_allocate=True, threads=None):
+    def upload(self, callback=do_nothing, pre_allocate=True, threads=None,
+               processes=None, chunk_size=262144, sendfile=False,
+               stall_timeout=None, failover=False):
         """Test upload speed against speedtest.net
 
         A ``threads`` value of ``None`` will fall back to those dictated
         by the speedtest.net configuration
+
+        A ``processes`` value greater than ``1`` shards the requests across
+        that many worker processes, with ``threads`` divided between them
+
+        ``chunk_size`` is the number of bytes written to the socket at a
+        time, and how often the test length is checked
+
+        A ``sendfile`` value of ``True`` sends request bodies from a file
+        descriptor with ``os.sendfile``, falling back to the regular upload
+        path for HTTPS or where ``os.sendfile`` is unavailable
+
+        ``stall_timeout`` and ``failover`` work as for ``download``
         """
 
+        if stall_timeout and processes and processes > 1:
+            raise SpeedtestException('stall_timeout is not supported with '
+                                     'processes')
+
         sizes = []
 
         for size in self.config['sizes']['upload']:
@@ -1543,32 +4019,74 @@ class Speedtest(object):
 
         # request_count = len(sizes)
         request_count = self.config['upload_max']
-
-        requests = []
-        for i, size in enumerate(sizes):
-            # We set ``0`` for ``start`` and handle setting the actual
-            # ``start`` in ``HTTPUploader`` to get better measurements
-            data = HTTPUploaderData(
-                size,
-                0,
-                self.config['length']['upload'],
-                shutdown_event=self._shutdown_event
+        sizes = sizes[:request_count]
+
+        threads = threads or self.config['threads']['upload']
+
+        # Make sure the cached address outlives the test
+        self._resolve_best(self.config['length']['upload'] + self._timeout)
+
+        if sendfile and not sendfile_supported(self.best['url']):
+            printer('sendfile unavailable for %s, using the regular upload '
+                    'path' % self.best['url'], debug=True)
+            sendfile = False
+
+        multiprocess = processes and processes > 1
+        budget = self._take_budget('upload', multiprocess)
+        pacer = self._take_pacer(multiprocess)
+
+        if multiprocess:
+            # Streams run in the worker processes, and are not tracked
+            self._transfers['upload'] = []
+            bytes_sent, elapsed = self._run_processes(
+                'upload', sizes, processes, threads, callback,
+                {
+                    'length': self.config['length']['upload'],
+                    'pre_allocate': pre_allocate,
+                    'url': self.best['url'],
+                    'chunk_size': chunk_size,
+                    'sendfile': sendfile,
+                    'budget': budget,
+                    'pacer': pacer,
+                }
             )
-            if pre_allocate:
-                data.pre_allocate()
+        elif sendfile:
+            bytes_sent, elapsed = self._sendfile_upload(sizes, threads,
+                                                        callback,
+                                                        stall_timeout,
+                                                        failover, budget,
+                                                        pacer)
+        else:
+            payloads = UploadPayloads()
+
+            def build_upload(size, url):
+                # We set ``0`` for ``start`` and handle setting the actual
+                # ``start`` in ``HTTPUploader`` to get better measurements
+                data = HTTPUploaderData(
+                    size,
+                    0,
+                    self.config['length']['upload'],
+                    shutdown_event=self._shutdown_event,
+                    chunk_size=chunk_size,
+                    budget=budget,
+                    pacer=pacer
+                )
+                if pre_allocate:
+                    data.pre_allocate(payloads)
 
-            headers = {'Content-length': size}
-            requests.append(
-                (
-                    build_request(self.best['url'], data, secure=self._secure,
+                headers = {'Content-length': size}
+                return (
+                    build_request(url, data, secure=self._secure,
                                   headers=headers),
                     size
                 )
-            )
 
-        def producer(q, requests, request_count):
-            for i, request in enumerate(requests[:request_count]):
-                thread = HTTPUploader(
+            requests = []
+            for size in sizes:
+                requests.append(build_upload(size, self.best['url']))
+
+            def build_thread(i, request):
+                return HTTPUploader(
                     i,
                     request[0],
                     start,
@@ -1577,40 +4095,416 @@ class Speedtest(object):
                     opener=self._opener,
                     shutdown_event=self._shutdown_event
                 )
-                thread.start()
-                q.put(thread, True)
-                callback(i, request_count, start=True)
-
-        finished = []
 
-        def consumer(q, request_count):
-            while len(finished) < request_count:
-                thread = q.get(True)
-                while thread.isAlive():
-                    thread.join(timeout=0.1)
-                finished.append(thread.result)
-                callback(thread.i, request_count, end=True)
-
-        q = Queue(threads or self.config['threads']['upload'])
-        prod_thread = threading.Thread(target=producer,
-                                       args=(q, requests, request_count))
-        cons_thread = threading.Thread(target=consumer,
-                                       args=(q, request_count))
-        start = timeit.default_timer()
-        prod_thread.start()
-        cons_thread.start()
-        while prod_thread.isAlive():
-            prod_thread.join(timeout=0.1)
-        while cons_thread.isAlive():
-            cons_thread.join(timeout=0.1)
-
-        stop = timeit.default_timer()
-        self.results.bytes_sent = sum(finished)
+            def replace(thread, server):
+                url = self.best['url']
+                if server is not None:
+                    url = server['url']
+                return build_thread(thread.i,
+                                    build_upload(requests[thread.i][1], url))
+
+            started = self._transfers_started('upload')
+            start = timeit.default_timer()
+            watchdog = self._watch('upload', replace, stall_timeout, failover)
+            run_transfers(requests, build_thread, threads, callback, started)
+            self._unwatch('upload', watchdog)
+            elapsed = timeit.default_timer() - start
+            bytes_sent = sum([thread.transferred for thread in started])
+
+        self.results.bytes_sent = int(bytes_sent)
         self.results.upload = (
-            (self.results.bytes_sent / (stop - start)) * 8.0
+            (self.results.bytes_sent / elapsed) * 8.0
         )
+        self._spend_budget(budget)
+        self._spend_pacer('upload', pacer)
+        self.results.streams['upload'] = stream_stats(
+            self._transfers['upload']
+        )
+        self._record_connections()
         return self.results.upload
 
+    def _sendfile_upload(self, sizes, threads, callback, stall_timeout=None,
+                         failover=False, budget=None, pacer=None):
+        """Run the upload test with ``HTTPSendfileUploader`` threads, and
+        return the number of bytes sent and the elapsed time
+        """
+
+        build_connection = self._connection_factory()
+
+        payload = UploadPayloadFile(max(sizes))
+        try:
+            requests = build_sendfile_requests(self.best['url'], sizes,
+                                               payload, build_user_agent())
+
+            def build_thread(i, request):
+                return HTTPSendfileUploader(
+                    i,
+                    request[0],
+                    start,
+                    request[1],
+                    self.config['length']['upload'],
+                    build_connection,
+                    payload,
+                    shutdown_event=self._shutdown_event,
+                    budget=budget,
+                    pacer=pacer
+                )
+
+            def replace(thread, server):
+                request = requests[thread.i]
+                if server is not None:
+                    request = (retarget_request(request[0], self.best['url'],
+                                                server['url']),
+                               request[1])
+                return build_thread(thread.i, request)
+
+            started = self._transfers_started('upload')
+            start = timeit.default_timer()
+            watchdog = self._watch('upload', replace, stall_timeout, failover)
+            run_transfers(requests, build_thread, threads, callback, started)
+            self._unwatch('upload', watchdog)
+            elapsed = timeit.default_timer() - start
+        finally:
+            payload.close()
+
+        return sum([thread.transferred for thread in started]), elapsed
+
+    def dual_stack(self, callback=do_nothing, download=True, upload=True,
+                   download_kwargs=None, upload_kwargs=None):
+        """Test the best server once over IPv4 and once over IPv6, pinning
+        every connection of each pass to that address family, and return a
+        ``SpeedtestDualStackResults``
+
+        ``download_kwargs`` and ``upload_kwargs`` are passed through to
+        ``download`` and ``upload``. ``self.results`` is left as it was
+        """
+
+        families = (('ipv4', socket.AF_INET),)
+        if socket.has_ipv6:
+            families += (('ipv6', socket.AF_INET6),)
+
+        saved = (self._resolver, self._opener, self.results, self._pool)
+        tested = {}
+        errors = {}
+        if not socket.has_ipv6:
+            errors['ipv6'] = 'This version of Python does not support IPv6'
+
+        try:
+            for name, family in families:
+                self._resolver = DNSCache(saved[0].ttl, family=family)
+                self._pool = ConnectionPool(saved[3].max_idle)
+                self._opener = build_opener(self._source_address,
+                                            self._timeout, self._resolver,
+                                            self._socket_options,
+                                            self._tls_cache, self._pool)
+                self.results = SpeedtestResults(
+                    client=self.config['client'],
+                    opener=self._opener,
+                    secure=self._secure,
+                )
+                self.results.socket_options = saved[2].socket_options
+
+                printer('Testing %s' % ADDRESS_FAMILIES[family], debug=True)
+                try:
+                    self._resolve_best()
+                    h = self._connection_factory()(
+                        urlparse(self.best['url'])[1]
+                    )
+                    h.connect()
+                    h.close()
+                except HTTP_ERRORS:
+                    errors[name] = '%s' % get_exception()
+                    printer('%s unavailable: %s' %
+                            (ADDRESS_FAMILIES[family], errors[name]),
+                            debug=True)
+                    continue
+
+                latency = self.server_latency(self.best)
+                self.results.ping = latency
+                self.results.server = dict(self.best, latency=latency)
+                if self._prewarm:
+                    self._warm_best()
+
+                try:
+                    try:
+                        if download:
+                            self.download(callback=callback,
+                                          **(download_kwargs or {}))
+                        if upload:
+                            self.upload(callback=callback,
+                                        **(upload_kwargs or {}))
+                    except HTTP_ERRORS + (SpeedtestException,):
+                        errors[name] = '%s' % get_exception()
+                        continue
+                finally:
+                    self._pool.clear()
+                self._record_connections()
+                tested[name] = self.results
+        finally:
+            self._resolver, self._opener, self.results, self._pool = saved
+
+        return SpeedtestDualStackResults(errors=errors, **tested)
+
+    def duplex(self, callback=do_nothing, download_kwargs=None,
+               upload_kwargs=None, interval=0.5):
+        """Test download and upload speed at the same time, on separate
+        sets of connections, sampling each direction every ``interval``
+        seconds
+
+        One-way download and upload tests are run first if they have not
+        been already. The duplex rates, the degradation of each relative
+        to its one-way rate and the per-interval samples are stored in
+        ``self.results.duplex``, which is also returned
+        """
+
+        download_kwargs = download_kwargs or {}
+        upload_kwargs = upload_kwargs or {}
+
+        if not self.results.download:
+            self.download(callback=callback, **download_kwargs)
+        if not self.results.upload:
+            self.upload(callback=callback, **upload_kwargs)
+
+        # Both directions start on cold connections
+        self._pool.clear()
+
+        oneway = self.results
+        self.results = SpeedtestResults(
+            client=self.config['client'],
+            opener=self._opener,
+            secure=self._secure,
+        )
+
+        # Split the remaining budget between the directions up front, as
+        # either may start first
+        if self.budget is not None:
+            remaining = max(0, self.budget - self.budget_used -
+                            self._budget_reserved)
+            self._budget_split = {
+                'download': remaining // 2,
+                'upload': remaining - remaining // 2,
+            }
+
+        errors = []
+
+        def run(test, kwargs):
+            try:
+                test(callback=callback, **kwargs)
+            except HTTP_ERRORS + (SpeedtestException,):
+                errors.append(get_exception())
+
+        samplers = {}
+        threads = []
+        try:
+            for direction, test, kwargs in (
+                    ('download', self.download, download_kwargs),
+                    ('upload', self.upload, upload_kwargs)):
+                samplers[direction] = TransferSampler(
+                    lambda direction=direction: self._transfers[direction],
+                    interval
+                )
+                threads.append(threading.Thread(target=run,
+                                                args=(test, kwargs)))
+            for direction in samplers:
+                samplers[direction].start()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                while is_alive(thread):
+                    thread.join(timeout=0.1)
+            for sampler in samplers.values():
+                sampler.finish()
+            duplex = self.results
+        finally:
+            self.results = oneway
+            self._budget_split = {}
+
+        if errors:
+            raise errors[0]
+
+        degradation = {}
+        for direction in ('download', 'upload'):
+            rate = getattr(oneway, direction)
+            if rate:
+                degradation[direction] = round(
+                    1 - getattr(duplex, direction) / float(rate), 4
+                )
+            else:
+                degradation[direction] = None
+
+        self.results.duplex = {
+            'download': duplex.download,
+            'upload': duplex.upload,
+            'bytes_received': duplex.bytes_received,
+            'bytes_sent': duplex.bytes_sent,
+            'degradation': degradation,
+            'samples': dict((direction, sampler.rates())
+                            for direction, sampler in samplers.items()),
+        }
+        printer('Duplex:\n%r' % self.results.duplex, debug=True)
+        return self.results.duplex
+
+    def _take_budget(self, direction, shared=False):
+        """Return the ``ByteBudget`` for a ``direction`` test, or ``None``
+        without a session budget
+
+        A download that runs before the upload test may use half of the
+        remaining session budget, leaving the rest for the upload. The
+        grant is reserved until ``_spend_budget``, so that tests running at
+        the same time never grant the same bytes twice
+        """
+
+        if self.budget is None:
+            return None
+        self._budget_lock.acquire()
+        try:
+            remaining = max(0, self.budget - self.budget_used -
+                            self._budget_reserved)
+            if direction in self._budget_split:
+                remaining = min(remaining,
+                                self._budget_split.pop(direction))
+            elif direction == 'download' and not self.results.bytes_sent:
+                remaining = remaining // 2
+            self._budget_reserved += remaining
+        finally:
+            self._budget_lock.release()
+        return ByteBudget(remaining, shared=shared)
+
+    def _spend_budget(self, budget):
+        """Charge the bytes used from ``budget`` to the session budget, and
+        record the budget use in the results
+        """
+
+        if budget is None:
+            return
+        self._budget_lock.acquire()
+        try:
+            self._budget_reserved -= budget.limit
+            self.budget_used += budget.used
+        finally:
+            self._budget_lock.release()
+        self.results.budget = {
+            'limit': self.budget,
+            'used': self.budget_used,
+            'limited': (self.results.budget.get('limited', False) or
+                        budget.exhausted),
+        }
+        if budget.exhausted:
+            printer('Byte budget of %d bytes exhausted' % budget.limit,
+                    debug=True)
+
+    def _take_pacer(self, shared=False):
+        """Return the ``TokenBucket`` for a test, reset for it, or ``None``
+        without a session pace
+
+        Tests in the same process share the session bucket, so that
+        concurrent download and upload streams are paced together
+        """
+
+        if not self.pace:
+            return None
+        if shared:
+            pacer = TokenBucket(self.pace, shared=True)
+        else:
+            pacer = self._pacer
+        pacer.reset(self.pace_probe)
+        return pacer
+
+    def _spend_pacer(self, direction, pacer):
+        """Record in the results whether the ``direction`` test through
+        ``pacer`` validated the session pace as a minimum rate
+
+        With a probe, the link has to carry the pace during the probe.
+        Otherwise the paced streams have to keep up with the pace for the
+        whole test, within 5%
+        """
+
+        if pacer is None:
+            return
+        rate, probe = pacer.measured()
+        if probe is None:
+            validated = rate >= self.pace * 0.95
+        else:
+            validated = probe >= self.pace
+        self.results.pacing[direction] = {
+            'pace': self.pace,
+            'probe': self.pace_probe,
+            'rate': rate,
+            'probe_rate': probe,
+            'validated': validated,
+        }
+        printer('Pacing %s:\n%r' % (direction, self.results.pacing[direction]),
+                debug=True)
+
+    def _watch(self, direction, replace, stall_timeout, failover):
+        """Start and return a ``StallWatchdog`` over the transfer threads of
+        the ``direction`` test, or return ``None`` without a
+        ``stall_timeout``
+        """
+
+        self.results.stalls.pop(direction, None)
+        if not stall_timeout:
+            return None
+
+        servers = []
+        if failover:
+            for server in self.closest:
+                if server['url'] != self.best['url']:
+                    servers.append(server)
+
+        watchdog = StallWatchdog(lambda: self._transfers[direction], replace,
+                                 stall_timeout, servers)
+        watchdog.start()
+        return watchdog
+
+    def _unwatch(self, direction, watchdog):
+        """Stop ``watchdog``, once the regular streams have finished, and
+        record its stalls
+        """
+
+        if watchdog is None:
+            return
+        watchdog.finish()
+        if watchdog.stalls:
+            self.results.stalls[direction] = watchdog.stalls
+
+    def _transfers_started(self, direction):
+        """Return a fresh list to collect the transfer threads of the
+        ``direction`` test in, replacing that of any earlier test
+        """
+
+        self._transfers[direction] = []
+        return self._transfers[direction]
+
+    def _connection_factory(self):
+        """Return a ``connection_factory`` for the best server using the
+        session settings
+        """
+
+        return connection_factory(
+            self.best['url'],
+            self._source_address,
+            self._timeout,
+            resolver=self._resolver,
+            socket_options=self._socket_options,
+            tls_cache=self._tls_cache,
+            pool=self._pool
+        )
+
+    def _record_connections(self):
+        """Copy the address family used to reach the best server, and TLS
+        handshake counts if any HTTPS connections were made, into the
+        results
+        """
+
+        family = self._resolver.family(urlparse(self.best['url']).hostname)
+        self.results.family = ADDRESS_FAMILIES.get(family)
+
+        if self._tls_cache is not None and self._tls_cache.handshakes:
+            self.results.tls = self._tls_cache.dict()
+            printer('TLS handshakes: %(handshakes)d, resumed: %(resumed)d' %
+                    self.results.tls, debug=True)
+
 
 def ctrl_c(shutdown_event):
     """Catch Ctrl-C key sequence and set a SHUTDOWN_EVENT for our threaded
@@ -1631,10 +4525,13 @@ def version():
     sys.exit(0)
 
 
-def csv_header(delimiter=','):
+def csv_header(delimiter=',', dual_stack=False):
     """Print the CSV Headers"""
 
-    printer(SpeedtestResults.csv_header(delimiter=delimiter))
+    if dual_stack:
+        printer(SpeedtestDualStackResults.csv_header(delimiter=delimiter))
+    else:
+        printer(SpeedtestResults.csv_header(delimiter=delimiter))
     sys.exit(0)
 
 
@@ -1664,6 +4561,11 @@ def parse_args():
                         help='Only use a single connection instead of '
                              'multiple. This simulates a typical file '
                              'transfer.')
+    parser.add_argument('--processes', default=None, type=PARSER_TYPE_INT,
+                        help='Number of worker processes to shard download '
+                             'and upload connections across. Use on fast '
+                             'links where a single Python process cannot '
+                             'keep up. Default 1')
     parser.add_argument('--bytes', dest='units', action='store_const',
                         const=('byte', 8), default=('bit', 1),
                         help='Display values in bytes instead of bits. Does '
@@ -1704,6 +4606,20 @@ def parse_args():
     parser.add_argument('--secure', action='store_true',
                         help='Use HTTPS instead of HTTP when communicating '
                              'with speedtest.net operated servers')
+    parser.add_argument('--rcvbuf', type=PARSER_TYPE_INT,
+                        help='Set SO_RCVBUF in bytes on test connections')
+    parser.add_argument('--sndbuf', type=PARSER_TYPE_INT,
+                        help='Set SO_SNDBUF in bytes on test connections')
+    parser.add_argument('--nodelay', action='store_true', default=None,
+                        help='Set TCP_NODELAY on test connections')
+    parser.add_argument('--quickack', action='store_true', default=None,
+                        help='Set TCP_QUICKACK on test connections')
+    parser.add_argument('--congestion', type=PARSER_TYPE_STR,
+                        help='TCP congestion control algorithm to use for '
+                             'test connections, such as cubic or bbr')
+    parser.add_argument('--notsent-lowat', type=PARSER_TYPE_INT,
+                        help='Set TCP_NOTSENT_LOWAT in bytes on test '
+                             'connections')
     parser.add_argument('--no-pre-allocate', dest='pre_allocate',
                         action='store_const', default=True, const=False,
                         help='Do not pre allocate upload data. Pre allocation '
@@ -1711,6 +4627,53 @@ def parse_args():
                              'performance. To support systems with '
                              'insufficient memory, use this option to avoid a '
                              'MemoryError')
+    parser.add_argument('--raw', action='store_true', default=False,
+                        help='Perform the download test over bare sockets '
+                             'instead of urllib. Does not support proxies')
+    parser.add_argument('--pipeline', default=None, type=PARSER_TYPE_INT,
+                        help='Number of download requests to keep in flight '
+                             'on each keep-alive connection. Implies --raw')
+    parser.add_argument('--sendfile', action='store_true', default=False,
+                        help='Send upload data with os.sendfile from a '
+                             'memory backed file. Ignored for HTTPS, or where '
+                             'os.sendfile is unavailable')
+    parser.add_argument('--upload-chunk-size', default=262144,
+                        type=PARSER_TYPE_INT,
+                        help='Number of bytes written to the socket at a time '
+                             'during the upload test. Default 262144')
+    parser.add_argument('--stall-timeout', default=None,
+                        type=PARSER_TYPE_FLOAT,
+                        help='Abort and replace download and upload streams '
+                             'that make no progress for this many seconds')
+    parser.add_argument('--stall-failover', action='store_true',
+                        default=False,
+                        help='Send replacements for stalled streams to the '
+                             'next closest servers. Requires --stall-timeout')
+    parser.add_argument('--budget', default=None, type=PARSER_TYPE_INT,
+                        help='Maximum number of bytes the download and '
+                             'upload tests may transfer together. Half of '
+                             'the budget is kept for the upload test')
+    parser.add_argument('--pace', default=None, type=PARSER_TYPE_FLOAT,
+                        help='Pace the download and upload streams together '
+                             'to this many Mbit/s, to check a minimum rate '
+                             'without saturating the link')
+    parser.add_argument('--pace-probe', default=None, type=PARSER_TYPE_FLOAT,
+                        help='Run each test unpaced for this many seconds '
+                             'before backing off to --pace. Requires --pace')
+    parser.add_argument('--auto-size', action='store_true', default=False,
+                        help='Estimate the bandwidth with a short probe, and '
+                             'pick download and upload sizes to suit it')
+    parser.add_argument('--no-prewarm', dest='prewarm', default=True,
+                        action='store_false',
+                        help='Do not open connections to the selected server '
+                             'ahead of the download test')
+    parser.add_argument('--duplex', action='store_true', default=False,
+                        help='After the one-way tests, run the download and '
+                             'upload tests at the same time and report the '
+                             'degradation')
+    parser.add_argument('--dual-stack', action='store_true', default=False,
+                        help='Test the selected server over both IPv4 and '
+                             'IPv6, and report the results side by side')
     parser.add_argument('--version', action='store_true',
                         help='Show the version number and exit')
     parser.add_argument('--debug', action='store_true',
@@ -1734,6 +4697,7 @@ def validate_optional_args(args):
     optional_args = {
         'json': ('json/simplejson python module', json),
         'secure': ('SSL support', HTTPSConnection),
+        'processes': ('multiprocessing python module', multiprocessing),
     }
 
     for arg, info in optional_args.items():
@@ -1763,6 +4727,45 @@ def printer(string, quiet=False, debug=False, error=False, **kwargs):
         print_(out, **kwargs)
 
 
+def print_dual_stack(dual, args):
+    """Print ``SpeedtestDualStackResults`` in the format selected by
+    ``args``
+    """
+
+    printer('Results:\n%r' % dual.dict(), debug=True)
+
+    if args.csv:
+        printer(dual.csv(delimiter=args.csv_delimiter))
+        return
+    elif args.json:
+        printer(dual.json())
+        return
+
+    for name, label in (('ipv4', 'IPv4'), ('ipv6', 'IPv6')):
+        results = getattr(dual, name)
+        if results is None:
+            printer('%s: unavailable (%s)' %
+                    (label, dual.errors.get(name, 'not tested')))
+            continue
+        printer('%s: Ping: %s ms, Download: %0.2f M%s/s, Upload: %0.2f M%s/s' %
+                (label, results.ping,
+                 (results.download / 1000.0 / 1000.0) / args.units[1],
+                 args.units[0],
+                 (results.upload / 1000.0 / 1000.0) / args.units[1],
+                 args.units[0]))
+
+    ratio = dual.ratio()
+    if ratio['download'] is None and ratio['upload'] is None:
+        return
+    values = []
+    for key in ('download', 'upload', 'ping'):
+        if ratio[key] is None:
+            values.append('n/a')
+        else:
+            values.append('%0.2f' % ratio[key])
+    printer('IPv6/IPv4: Download: %s, Upload: %s, Ping: %s' % tuple(values))
+
+
 def shell():
     """Run the full speedtest.net test"""
 
@@ -1785,7 +4788,32 @@ def shell():
         raise SpeedtestCLIError('--csv-delimiter must be a single character')
 
     if args.csv_header:
-        csv_header(args.csv_delimiter)
+        csv_header(args.csv_delimiter, dual_stack=args.dual_stack)
+
+    if args.dual_stack and args.share:
+        raise SpeedtestCLIError('Cannot supply both --dual-stack and --share')
+
+    if args.duplex and (args.dual_stack or not args.download or
+                        not args.upload):
+        raise SpeedtestCLIError('--duplex requires both the download and '
+                                'upload tests, and cannot be combined with '
+                                '--dual-stack')
+
+    if args.stall_failover and not args.stall_timeout:
+        raise SpeedtestCLIError('--stall-failover requires --stall-timeout')
+
+    if (args.stall_timeout and args.processes and args.processes > 1 and
+            not args.single):
+        raise SpeedtestCLIError('Cannot supply both --stall-timeout and '
+                                '--processes')
+
+    if args.pace_probe and not args.pace:
+        raise SpeedtestCLIError('--pace-probe requires --pace')
+
+    if args.pace:
+        pace = args.pace * 1000.0 * 1000.0
+    else:
+        pace = None
 
     validate_optional_args(args)
 
@@ -1816,8 +4844,22 @@ def shell():
         speedtest = Speedtest(
             source_address=args.source,
             timeout=args.timeout,
-            secure=args.secure
+            secure=args.secure,
+            prewarm=args.prewarm,
+            budget=args.budget,
+            pace=pace,
+            pace_probe=args.pace_probe,
+            socket_options={
+                'rcvbuf': args.rcvbuf,
+                'sndbuf': args.sndbuf,
+                'nodelay': args.nodelay,
+                'quickack': args.quickack,
+                'congestion': args.congestion,
+                'notsent_lowat': args.notsent_lowat,
+            }
         )
+    except SpeedtestSocketOptionError:
+        raise SpeedtestCLIError(get_exception())
     except (ConfigRetrievalError,) + HTTP_ERRORS:
         printer('Cannot retrieve speedtest configuration', error=True)
         raise SpeedtestCLIError(get_exception())
@@ -1847,7 +4889,8 @@ def shell():
     if not args.mini:
         printer('Retrieving speedtest.net server list...', quiet)
         try:
-            speedtest.get_servers(servers=args.server, exclude=args.exclude)
+            speedtest.get_servers(servers=args.server, exclude=args.exclude,
+                                  probe=True)
         except NoMatchedServers:
             raise SpeedtestCLIError(
                 'No matched servers: %s' %
@@ -1875,13 +4918,46 @@ def shell():
     printer('Hosted by %(sponsor)s (%(name)s) [%(d)0.2f km]: '
             '%(latency)s ms' % results.server, quiet)
 
-    if args.download:
-        printer('Testing download speed', quiet,
+    if args.auto_size:
+        printer('Probing bandwidth to select test sizes...', quiet)
+        speedtest.auto_size()
+
+    download_kwargs = {
+        'threads': (None, 1)[args.single],
+        'processes': (args.processes, None)[args.single],
+        'raw': args.raw,
+        'pipeline': args.pipeline,
+        'stall_timeout': args.stall_timeout,
+        'failover': args.stall_failover,
+    }
+    upload_kwargs = {
+        'pre_allocate': args.pre_allocate,
+        'threads': (None, 1)[args.single],
+        'processes': (args.processes, None)[args.single],
+        'chunk_size': args.upload_chunk_size,
+        'sendfile': args.sendfile,
+        'stall_timeout': args.stall_timeout,
+        'failover': args.stall_failover,
+    }
+
+    if args.dual_stack:
+        printer('Testing over IPv4 and IPv6', quiet,
                 end=('', '\n')[bool(debug)])
-        speedtest.download(
+        dual = speedtest.dual_stack(
             callback=callback,
-            threads=(None, 1)[args.single]
+            download=args.download,
+            upload=args.upload,
+            download_kwargs=download_kwargs,
+            upload_kwargs=upload_kwargs
         )
+        printer('', quiet)
+        print_dual_stack(dual, args)
+        return
+
+    if args.download:
+        printer('Testing download speed', quiet,
+                end=('', '\n')[bool(debug)])
+        speedtest.download(callback=callback, **download_kwargs)
         printer('Download: %0.2f M%s/s' %
                 ((results.download / 1000.0 / 1000.0) / args.units[1],
                  args.units[0]),
@@ -1892,11 +4968,7 @@ def shell():
     if args.upload:
         printer('Testing upload speed', quiet,
                 end=('', '\n')[bool(debug)])
-        speedtest.upload(
-            callback=callback,
-            pre_allocate=args.pre_allocate,
-            threads=(None, 1)[args.single]
-        )
+        speedtest.upload(callback=callback, **upload_kwargs)
         printer('Upload: %0.2f M%s/s' %
                 ((results.upload / 1000.0 / 1000.0) / args.units[1],
                  args.units[0]),
@@ -1904,6 +4976,35 @@ def shell():
     else:
         printer('Skipping upload test', quiet)
 
+    if args.duplex:
+        printer('Testing simultaneous download and upload', quiet,
+                end=('', '\n')[bool(debug)])
+        duplex = speedtest.duplex(
+            callback=callback,
+            download_kwargs=download_kwargs,
+            upload_kwargs=upload_kwargs
+        )
+        for direction in ('download', 'upload'):
+            printer('Duplex %s: %0.2f M%s/s (%0.1f%% below one-way)' %
+                    (direction.capitalize(),
+                     (duplex[direction] / 1000.0 / 1000.0) / args.units[1],
+                     args.units[0],
+                     (duplex['degradation'][direction] or 0) * 100),
+                    quiet)
+
+    for direction in ('download', 'upload'):
+        if direction in results.pacing:
+            printer('%s minimum rate of %0.2f Mbit/s %s' %
+                    (direction.capitalize(), args.pace,
+                     ('not validated', 'validated')[
+                         results.pacing[direction]['validated']
+                     ]),
+                    quiet)
+
+    if results.budget.get('limited'):
+        printer('Stopped at the byte budget after %(used)d of %(limit)d '
+                'bytes' % results.budget, quiet)
+
     printer('Results:\n%r' % results.dict(), debug=True)
 
     if not args.simple and args.share: